@@ -0,0 +1,24 @@
+# Encoder micro-benchmarks: python benchmarks/bench_encode.py
+from __future__ import print_function
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from protowire.protobuf import encode_message, encode_varint
+
+CASES = [
+    ('encode_varint small', lambda: encode_varint(100)),
+    ('encode_varint large', lambda: encode_varint(123456789)),
+    ('encode_message int', lambda: encode_message(3, 'int', 100)),
+    ('encode_message sint32', lambda: encode_message(4, 'sint32', -100)),
+    ('encode_message string', lambda: encode_message(2, 'string', 'testing')),
+    ('encode_message packed int', lambda: encode_message(5, 'int', [1, 2, 3, 150, 300])),
+]
+
+def main(number=200000):
+    for name, func in CASES:
+        t = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-28s %8.0f ns/call' % (name, t / number * 1e9))
+
+if __name__ == '__main__':
+    main()
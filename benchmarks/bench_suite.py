@@ -0,0 +1,257 @@
+# Throughput benchmarks of the encode, decode and GRPC framing hot paths on
+# reproducible synthetic corpora:
+#
+#   python benchmarks/bench_suite.py                        # print a table
+#   python benchmarks/bench_suite.py --json results.json    # also save JSON
+#   python benchmarks/bench_suite.py --baseline benchmarks/baseline.json
+#
+# With --baseline, each case is compared to the stored result and the exit
+# code is 1 if any of them is slower than allowed by --tolerance. Baselines
+# are machine-specific: create one with --json before making changes.
+from __future__ import print_function
+import argparse, json, os, platform, random, sys, timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from protowire.protobuf import encode_message
+from protowire.proto_decoding import parse_bytes, parse_stream_with_spec, parse_spec, \
+    SpecParser
+from protowire.grpc_frame import wrap_grpc_stream, unwrap_grpc_stream, encode_grpc_frame
+
+SEED = 1234
+
+def collection(messages):
+    return b''.join(encode_message(1, 'bytes', msg) for msg in messages)
+
+# corpora: (values, encoded messages) with a fixed seed
+
+def small_int_values(rng, n):
+    return [(rng.randint(0, 1000), rng.randint(-1000, 1000), rng.choice(['true', 'false']))
+        for _ in range(n)]
+
+def encode_small_ints(values):
+    return [encode_message(1, 'int', a) + encode_message(2, 'sint32', b) + encode_message(3, 'bool', c)
+        for a, b, c in values]
+
+def long_string_values(rng, n, length=2000):
+    letters = 'abcdefghijklmnopqrstuvwxyz '
+    return [''.join(rng.choice(letters) for _ in range(length)) for _ in range(n)]
+
+def encode_long_strings(values):
+    return [encode_message(1, 'string', s) for s in values]
+
+def packed_values(rng, n):
+    return [rng.randint(0, 1 << 20) for _ in range(n)], [rng.random() for _ in range(n)]
+
+def encode_packed(values):
+    ints, doubles = values
+    return encode_message(1, 'int', ints) + encode_message(2, 'double', doubles)
+
+# 50 fields: ints, short strings, multi-KB blobs and submessages
+def wide_message(rng):
+    msg = b''
+    for field in range(1, 51):
+        kind = field % 4
+        if kind == 0:
+            msg += encode_message(field, 'int', rng.randint(1, 1 << 30))
+        elif kind == 1:
+            msg += encode_message(field, 'string', 'value %d' % field)
+        elif kind == 2:
+            msg += encode_message(field, 'bytes', b'b' * rng.randint(1000, 8000))
+        else:
+            msg += encode_message(field, 'bytes', encode_message(1, 'int', field) * 20)
+    return msg
+
+def deep_message(depth):
+    msg = encode_message(2, 'int', depth)
+    for level in range(depth):
+        msg = encode_message(1, 'bytes', msg) + encode_message(2, 'int', level)
+    return msg
+
+def deep_spec(depth):
+    spec = '2:int'
+    for _ in range(depth):
+        spec = '1:{%s},2:int' % spec
+    return spec
+
+class Corpora(object):
+    def __init__(self, scale=1.0):
+        rng = random.Random(SEED)
+        size = lambda n: max(1, int(n * scale))
+        self.small_ints = small_int_values(rng, size(20000))
+        self.small_int_messages = encode_small_ints(self.small_ints)
+        self.small_int_collection = collection(self.small_int_messages)
+        self.long_strings = long_string_values(rng, size(500))
+        self.long_string_collection = collection(encode_long_strings(self.long_strings))
+        self.packed = packed_values(rng, size(100000))
+        self.packed_message = encode_packed(self.packed)
+        self.deep_depth = 50
+        self.deep_messages = [deep_message(self.deep_depth)] * size(1000)
+        self.deep_collection = collection(self.deep_messages)
+        self.wide_messages = [wide_message(rng) for _ in range(size(500))]
+        self.wide_collection = collection(self.wide_messages)
+        self.wide_stream = b''.join(self.wide_messages)
+        self.frame_messages = [b'x' * rng.randint(10, 2000) for _ in range(size(20000))]
+        self.frame_collection = collection(self.frame_messages)
+        self.frames = b''.join(encode_grpc_frame(m) for m in self.frame_messages)
+
+# name -> (function, input bytes, messages per call)
+def define_cases(corpora):
+    c = corpora
+    cases = {}
+
+    def case(name, n_bytes, n_messages):
+        def register(func):
+            cases[name] = (func, n_bytes, n_messages)
+            return func
+        return register
+
+    @case('encode_message/small_ints', len(c.small_int_collection), len(c.small_ints))
+    def _():
+        encode_small_ints(c.small_ints)
+
+    @case('encode_message/long_strings', len(c.long_string_collection), len(c.long_strings))
+    def _():
+        encode_long_strings(c.long_strings)
+
+    @case('encode_message/packed', len(c.packed_message), len(c.packed[0]) * 2)
+    def _():
+        encode_packed(c.packed)
+
+    @case('parse_bytes/small_ints', len(c.small_int_collection), len(c.small_ints))
+    def _():
+        for msg, _, _ in parse_bytes(c.small_int_collection):
+            parse_bytes(msg)
+
+    @case('parse_bytes/long_strings', len(c.long_string_collection), len(c.long_strings))
+    def _():
+        parse_bytes(c.long_string_collection)
+
+    small_int_spec = parse_spec('1:[1:int,2:sint32,3:bool]')
+    @case('parse_stream_with_spec/small_ints', len(c.small_int_collection), len(c.small_ints))
+    def _():
+        parse_stream_with_spec(BytesIO(c.small_int_collection), small_int_spec)
+
+    string_spec = parse_spec('1:[1:string]')
+    @case('parse_stream_with_spec/long_strings', len(c.long_string_collection), len(c.long_strings))
+    def _():
+        parse_stream_with_spec(BytesIO(c.long_string_collection), string_spec)
+
+    packed_spec = parse_spec('1:[int],2:[double]')
+    @case('parse_stream_with_spec/packed', len(c.packed_message), len(c.packed[0]) * 2)
+    def _():
+        parse_stream_with_spec(BytesIO(c.packed_message), packed_spec)
+
+    # 3 of the 50 fields
+    projection_spec = parse_spec('1:[4:int,5:string,7:{1:int}]')
+    @case('parse_stream_with_spec/projection', len(c.wide_collection), len(c.wide_messages))
+    def _():
+        parse_stream_with_spec(BytesIO(c.wide_collection), projection_spec)
+
+    # the same from the top level of a stream (repeated fields overwrite)
+    top_projection_spec = parse_spec('4:int,5:string,7:{1:int}')
+    @case('parse_stream_with_spec/top_level_projection', len(c.wide_stream), len(c.wide_messages))
+    def _():
+        parse_stream_with_spec(BytesIO(c.wide_stream), top_projection_spec)
+
+    nested_spec_string = '1:[%s]' % deep_spec(c.deep_depth)
+    nested_spec = parse_spec(nested_spec_string)
+    @case('parse_stream_with_spec/deep_nesting', len(c.deep_collection),
+          len(c.deep_messages) * c.deep_depth)
+    def _():
+        parse_stream_with_spec(BytesIO(c.deep_collection), nested_spec)
+
+    # parse_spec caches parsed specs, the parser itself is timed separately
+    n_specs = 200
+    @case('parse_spec/deep_nesting', len(nested_spec_string) * n_specs, n_specs)
+    def _():
+        for _ in range(n_specs):
+            SpecParser(nested_spec_string).parse()
+
+    @case('parse_spec/cached', len(nested_spec_string) * n_specs, n_specs)
+    def _():
+        for _ in range(n_specs):
+            parse_spec(nested_spec_string)
+
+    @case('wrap_grpc_stream', len(c.frame_collection), len(c.frame_messages))
+    def _():
+        wrap_grpc_stream(BytesIO(c.frame_collection), BytesIO())
+
+    @case('unwrap_grpc_stream', len(c.frames), len(c.frame_messages))
+    def _():
+        unwrap_grpc_stream(BytesIO(c.frames), BytesIO())
+
+    return cases
+
+# calls per timing so that each one takes at least min_time seconds
+def calibrate(func, min_time=0.2):
+    number = 1
+    while True:
+        if timeit.timeit(func, number=number) >= min_time:
+            return number
+        number *= 2
+
+def run(cases, repeat=5, selected=None):
+    results = {}
+    for name in sorted(cases):
+        if selected and not any(s in name for s in selected):
+            continue
+        func, n_bytes, n_messages = cases[name]
+        number = calibrate(func)
+        seconds = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+        results[name] = {
+            'seconds': seconds,
+            'mb_per_s': n_bytes / seconds / 1e6,
+            'msgs_per_s': n_messages / seconds
+        }
+        print('%-40s %10.1f MB/s %12.0f msgs/s' % (name, results[name]['mb_per_s'],
+            results[name]['msgs_per_s']), file=sys.stderr)
+    return results
+
+# names of the cases slower than the baseline by more than tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['mb_per_s'] / baseline[name]['mb_per_s']
+        print('%-40s %6.2fx baseline' % (name, ratio), file=sys.stderr)
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='protowire throughput benchmarks')
+    parser.add_argument('cases', nargs='*', help="run only cases whose name contains one of these")
+    parser.add_argument('--scale', type=float, default=1.0, help="corpus size multiplier")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare to results stored with --json")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="allowed relative slowdown compared to the baseline")
+    args = parser.parse_args()
+
+    results = run(define_cases(Corpora(args.scale)), args.repeat, args.cases)
+    output = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'scale': args.scale,
+        'results': results
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scale', 1.0) != args.scale:
+            print('warning: baseline was run with --scale %s' % baseline.get('scale'), file=sys.stderr)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('regressions: ' + ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
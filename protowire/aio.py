@@ -0,0 +1,97 @@
+# asyncio counterparts of the blocking stream functions for
+# asyncio.StreamReader / StreamWriter (Python 3.6+ only, not imported by the
+# other modules). The parsing is done by the same sans-IO StreamParser as
+# in the blocking versions.
+from .proto_decoding import StreamParser, parse_entry_bounds, \
+    parse_length_delimited_bounds, read_varint_from_buffer
+from .grpc_frame import grpc_frame_parser, append_grpc_frame, \
+    append_unwrapped_grpc_frame, get_compressor, FrameDecompressor, \
+    DEFAULT_CHUNK_SIZE
+from .protobuf import encode_key
+from .wire_type import VARINT, LENGTH_DELIM
+
+async def read_varint(reader):
+    data = bytearray()
+    while True:
+        b = await reader.read(1)
+        if not b:
+            if data:
+                raise RuntimeError("unexpected EOF while reading varint")
+            raise EOFError("EOF while reading varint")
+        data += b
+        if data[-1] < 0x80:
+            return read_varint_from_buffer(data, 0)[0]
+
+# yields (parsed entry, header info), see StreamParser
+async def parse_messages(reader, parser, chunk_size=DEFAULT_CHUNK_SIZE):
+    while True:
+        for entry in parser.messages():
+            yield entry
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            parser.close()
+            return
+        parser.feed(chunk)
+
+# like proto_decoding.parse_stream: (msg, field_number, wire_type)
+async def parse_stream(reader):
+    async for msg, (field_number, wire_type) in parse_messages(reader, StreamParser(parse_entry_bounds)):
+        if wire_type == VARINT:
+            yield read_varint_from_buffer(msg, 0)[0], field_number, wire_type
+        else:
+            yield bytes(msg), field_number, wire_type
+
+# decompressed GRPC messages
+async def read_grpc_frames(reader):
+    decompressor = FrameDecompressor()
+    async for frame, compressed_flag in parse_messages(reader, grpc_frame_parser()):
+        if compressed_flag:
+            yield decompressor.decompress(frame)
+        else:
+            yield bytes(frame)
+
+async def write_grpc_frame(writer, msg, compression=None):
+    buf = bytearray()
+    append_grpc_frame(buf, msg, get_compressor(compression))
+    writer.write(buf)
+    await writer.drain()
+
+async def flush(writer, buf):
+    if buf:
+        writer.write(bytes(buf))
+        del buf[:]
+        await writer.drain()
+
+async def wrap_grpc_stream(reader, writer, compression=None, flush_size=DEFAULT_CHUNK_SIZE):
+    compressor = get_compressor(compression)
+    buf = bytearray()
+    parser = StreamParser(parse_length_delimited_bounds, "length-delimited message")
+    while True:
+        for msg, _ in parser.messages():
+            append_grpc_frame(buf, msg, compressor)
+            if len(buf) >= flush_size:
+                await flush(writer, buf)
+        # flush before waiting for more input
+        await flush(writer, buf)
+        chunk = await reader.read(flush_size)
+        if not chunk:
+            parser.close()
+            return
+        parser.feed(chunk)
+
+async def unwrap_grpc_stream(reader, writer, tag=1, flush_size=DEFAULT_CHUNK_SIZE):
+    key = encode_key(tag, LENGTH_DELIM)
+    decompressor = FrameDecompressor()
+    buf = bytearray()
+    parser = grpc_frame_parser()
+    while True:
+        for frame, compressed_flag in parser.messages():
+            append_unwrapped_grpc_frame(buf, key, frame, compressed_flag, decompressor)
+            if len(buf) >= flush_size:
+                await flush(writer, buf)
+        await flush(writer, buf)
+        chunk = await reader.read(flush_size)
+        if not chunk:
+            parser.close()
+            return
+        parser.feed(chunk)
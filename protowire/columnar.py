@@ -0,0 +1,231 @@
+# Columnar export of length-delimited collections: each element is decoded
+# with a parse_spec spec and its scalar leaf fields are appended to typed
+# columns named by their field path, e.g., '3.1' for field 1 in field 3.
+# Numbers are stored in array.array buffers, strings and bytes in a single
+# bytearray with end offsets, and missing values are tracked in a separate
+# mask (the value is then 0 or empty). Rows are written out in chunks of
+# chunk_rows, so memory use does not grow with the size of the collection.
+#
+# The binary format is itself a length-delimited protobuf collection:
+#
+#   1: schema { repeated column { 1: name, 2: type } = 1 }
+#   2: chunk { 1: rows, repeated column { 1: present, 2: values, 3: offsets } = 2 } (repeated)
+#
+# where present has one 0/1 byte per row, values are the little-endian items
+# of the array (the concatenated payloads for string, bytes and hex columns)
+# and offsets are the end offsets of the payloads as unsigned 64-bit ints.
+import array
+import binascii
+import sys
+
+from .proto_decoding import compile_spec, decode_packed_fixed_array, packed_array_typecode, \
+    parse_stream, DECODERS
+from .protobuf import encode_message
+
+DEFAULT_CHUNK_ROWS = 64 * 1024
+
+VARIABLE_LENGTH_TYPES = ('string', 'bytes', 'hex')
+
+OFFSET_TYPE = 'fixed64'
+
+SCHEMA_FIELD = 1
+CHUNK_FIELD = 2
+
+SCHEMA_SPEC = {'1': [{'1': 'string', '2': 'string'}]}
+CHUNK_SPEC = {'1': 'int', '2': [{'1': 'bytes', '2': 'bytes', '3': 'bytes'}]}
+
+def array_bytes(arr):
+    if sys.byteorder != 'little':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    try:
+        return arr.tobytes() # Python 3
+    except AttributeError:
+        return arr.tostring() # Python 2
+
+class Column(object):
+    def __init__(self, name, proto_type):
+        if proto_type not in DECODERS:
+            raise RuntimeError("invalid type " + proto_type)
+        self.name = name
+        self.proto_type = proto_type
+        self.clear()
+
+    def clear(self):
+        self.present = bytearray()
+        if self.proto_type in VARIABLE_LENGTH_TYPES:
+            self.values = None
+            self.data = bytearray()
+            self.offsets = array.array(packed_array_typecode(OFFSET_TYPE))
+        else:
+            self.values = array.array(packed_array_typecode(self.proto_type))
+            self.data = self.offsets = None
+
+    def __len__(self):
+        return len(self.present)
+
+    # a decoded value or None if missing
+    def append(self, value):
+        if value is None:
+            self.present.append(0)
+            if self.values is None:
+                self.offsets.append(len(self.data))
+            else:
+                self.values.append(0)
+            return
+        self.present.append(1)
+        if self.values is None:
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            self.data += value
+            self.offsets.append(len(self.data))
+        else:
+            self.values.append(value)
+
+    # Python values, None for missing
+    def tolist(self):
+        if self.values is not None:
+            values = self.values.tolist()
+        else:
+            data = bytes(self.data)
+            starts = [0] + self.offsets.tolist()[:-1]
+            values = [data[start:end] for start, end in zip(starts, self.offsets)]
+            if self.proto_type != 'bytes':
+                values = [v.decode('utf-8') for v in values]
+        return [v if p else None for v, p in zip(values, self.present)]
+
+def encode_column(column):
+    if column.values is None:
+        values = column.data
+        offsets = encode_message(3, 'bytes', array_bytes(column.offsets))
+    else:
+        values = array_bytes(column.values)
+        offsets = b''
+    return encode_message(1, 'bytes', bytes(column.present)) + \
+        encode_message(2, 'bytes', bytes(values)) + offsets
+
+def decode_column(name, proto_type, entry):
+    column = Column(name, proto_type)
+    column.present = bytearray(entry.get('1', b''))
+    if column.values is None:
+        column.data = bytearray(entry.get('2', b''))
+        column.offsets = decode_packed_fixed_array(entry.get('3', b''), OFFSET_TYPE)
+    else:
+        column.values = decode_packed_fixed_array(entry.get('2', b''), proto_type)
+    return column
+
+# (column name, field keys, type) of the scalar leaves of a parse_spec spec,
+# in field number order (spec dicts are not ordered in Python 2)
+def spec_columns(spec, prefix=()):
+    if not isinstance(spec, dict):
+        raise RuntimeError("invalid spec (expected dict): " + str(spec))
+    columns = []
+    for field, decoder in sorted(spec.items(), key=lambda f: int(f[0])):
+        keys = prefix + (str(field),)
+        if isinstance(decoder, list):
+            raise RuntimeError("repeated field %s cannot be exported as a column" % '.'.join(keys))
+        if isinstance(decoder, dict):
+            columns.extend(spec_columns(decoder, keys))
+        else:
+            columns.append(('.'.join(keys), keys, decoder))
+    return columns
+
+# the csv module of Python 2 writes byte strings to a byte stream
+CSV_NEEDS_BYTES = sys.version_info[0] < 3
+
+# unicode strings to UTF-8, other values are written as they are
+def encode_cell(value):
+    if hasattr(value, 'encode') and not isinstance(value, bytes):
+        return value.encode('utf-8')
+    return value
+
+# text stream in Python 3, byte stream (UTF-8) in Python 2
+class CsvWriter(object):
+    def __init__(self, out_stream):
+        import csv
+        self.writer = csv.writer(out_stream, lineterminator='\n')
+
+    def write_header(self, columns):
+        self.writer.writerow([column.name for column in columns])
+
+    def write_chunk(self, columns):
+        def cells(column):
+            values = column.tolist()
+            if column.proto_type == 'bytes':
+                values = [None if v is None else binascii.hexlify(v).decode('utf-8') for v in values]
+            if CSV_NEEDS_BYTES:
+                values = [encode_cell(v) for v in values]
+            return values
+        # csv writes None as an empty cell
+        self.writer.writerows(zip(*[cells(column) for column in columns]))
+
+class ColumnarWriter(object):
+    def __init__(self, out_stream):
+        self.out_stream = out_stream
+
+    def write_header(self, columns):
+        schema = b''.join(encode_message(1, 'bytes',
+            encode_message(1, 'string', column.name) + encode_message(2, 'string', column.proto_type))
+            for column in columns)
+        self.out_stream.write(encode_message(SCHEMA_FIELD, 'bytes', schema))
+
+    def write_chunk(self, columns):
+        chunk = encode_message(1, 'int', len(columns[0])) + \
+            b''.join(encode_message(2, 'bytes', encode_column(column)) for column in columns)
+        self.out_stream.write(encode_message(CHUNK_FIELD, 'bytes', chunk))
+
+def flush_chunk(writer, columns):
+    writer.write_chunk(columns)
+    for column in columns:
+        column.clear()
+
+# Decodes the element messages with spec and writes them to writer (a
+# CsvWriter or ColumnarWriter) in chunks. Returns the number of rows
+def export_columns(messages, spec, writer, chunk_rows=DEFAULT_CHUNK_ROWS):
+    leaves = spec_columns(spec)
+    if not leaves:
+        raise RuntimeError("the spec has no scalar fields to export")
+    decode = compile_spec(spec).decode_bytes
+    columns = [Column(name, proto_type) for name, _, proto_type in leaves]
+    appenders = [(column.append, keys) for column, (_, keys, _) in zip(columns, leaves)]
+    writer.write_header(columns)
+    n_rows = 0
+    for msg in messages:
+        row = decode(msg)
+        for append, keys in appenders:
+            value = row
+            for key in keys:
+                value = value.get(key)
+                if value is None:
+                    break
+            append(value)
+        n_rows += 1
+        if len(columns[0]) == chunk_rows:
+            flush_chunk(writer, columns)
+    if len(columns[0]) > 0:
+        flush_chunk(writer, columns)
+    return n_rows
+
+# The chunks of a binary columnar file as lists of Columns
+def read_columnar(in_stream):
+    schema = None
+    decode_schema = compile_spec(SCHEMA_SPEC).decode_bytes
+    decode_chunk = compile_spec(CHUNK_SPEC).decode_bytes
+    for msg, field_number, _ in parse_stream(in_stream):
+        if field_number == SCHEMA_FIELD:
+            schema = [(c.get('1', ''), c.get('2', '')) for c in decode_schema(msg).get('1', [])]
+        elif field_number == CHUNK_FIELD:
+            if schema is None:
+                raise RuntimeError("columnar chunk before the schema")
+            chunk = decode_chunk(msg)
+            entries = chunk.get('2', [])
+            if len(entries) != len(schema):
+                raise RuntimeError("expected %d columns, got %d" % (len(schema), len(entries)))
+            columns = [decode_column(name, proto_type, entry)
+                for (name, proto_type), entry in zip(schema, entries)]
+            n_rows = chunk.get('1', 0)
+            for column in columns:
+                values = column.offsets if column.values is None else column.values
+                if len(column) != n_rows or len(values) != n_rows:
+                    raise RuntimeError("invalid length of column " + column.name)
+            yield columns
@@ -5,8 +5,108 @@ def ensure_binary(stream):
     except AttributeError:
         return stream # Python 2
 
+# pipes and terminals are written record by record, files in chunks
+def is_regular_file(stream):
+    import os, stat
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False # not a file descriptor
+
+def is_int(s):
+    try:
+        int(s)
+        return True
+    except ValueError:
+        return False
+
+# what argparse takes for a positional argument rather than an option
+def is_negative_number(s):
+    return s.startswith('-') and s[1:].replace('.', '', 1).isdigit() and not s.endswith('.')
+
+# [field_number] data_type [values...] without argparse, which is slow to
+# import for a command that is run once per field from shell scripts.
+# Returns None for anything else (e.g. --help or an unknown type), which is
+# then handled by argparse. On the command line, values starting with - are
+# options unless they are numbers or follow --, batch lines are literal
+def parse_pw_args(args, encoders, command_line=True):
+    field_number = 1
+    if args and is_int(args[0]):
+        field_number = int(args[0])
+        args = args[1:]
+    if not args or args[0] not in encoders:
+        return None
+    values = args[1:]
+    if command_line:
+        if values[:1] == ['--']:
+            values = values[1:]
+        elif any(v.startswith('-') and not is_negative_number(v) for v in values):
+            return None
+    return field_number, args[0], values
+
+def pw_value(values, in_stream):
+    if len(values) == 0:
+        return in_stream.read()
+    if len(values) == 1:
+        return values[0]
+    return values
+
+# One pw command per line, e.g.,
+#
+#   1 string "hello world"
+#   2 int 3 5      # packed
+#   3 {
+#     1 double 1.5
+#   }
+#
+# written as a single message, "[field_number] {" ... "}" encloses a nested
+# message. Replaces a pipeline of pw processes with one
+def pw_batch(in_stream, out_stream):
+    import shlex
+    from .protobuf import ENCODERS, MessageWriter
+
+    def split_line(line):
+        if isinstance('', bytes): # Python 2, shlex does not support unicode
+            return [token.decode('utf-8') for token in shlex.split(line, comments=True)]
+        return shlex.split(line.decode('utf-8'), comments=True)
+
+    writer = MessageWriter()
+    for line_number, line in enumerate(in_stream.read().splitlines(), 1):
+        tokens = split_line(line)
+        if not tokens:
+            continue
+        if tokens == ['}']:
+            if not writer.open_messages:
+                raise RuntimeError("line %d: unmatched }" % line_number)
+            writer.end_message()
+        elif tokens[-1] == '{' and len(tokens) <= 2 and all(is_int(t) for t in tokens[:-1]):
+            writer.begin_message(int(tokens[0]) if len(tokens) == 2 else 1)
+        else:
+            args = parse_pw_args(tokens, ENCODERS, command_line=False)
+            if args is None or not args[2]:
+                raise RuntimeError("line %d: expected [field_number] data_type values..." % line_number)
+            field_number, data_type, values = args
+            writer.write(field_number, data_type, pw_value(values, None))
+    out_stream.write(writer.getvalue())
+
 def pw():
     from .protobuf import ENCODERS, encode_message
+    import sys
+
+    if sys.argv[1:] == ['--batch']:
+        pw_batch(ensure_binary(sys.stdin), ensure_binary(sys.stdout))
+        return
+
+    args = parse_pw_args(sys.argv[1:], ENCODERS)
+    if args is None:
+        args = parse_pw_args_slow(ENCODERS)
+    field_number, data_type, values = args
+
+    msg = encode_message(field_number, data_type, pw_value(values, ensure_binary(sys.stdin)))
+    ensure_binary(sys.stdout).write(msg)
+
+# for help and error messages
+def parse_pw_args_slow(encoders):
     import argparse, sys
 
     # hack parameters to allow defaulting first argument to 1
@@ -17,59 +117,79 @@ def pw():
     except ValueError:
         field_number_present = False
 
-    parser = argparse.ArgumentParser(description='Write protobuf messages from low-level input')
+    parser = argparse.ArgumentParser(description='Write protobuf messages from low-level input',
+        epilog='pw --batch reads one "[field_number] data_type values..." command per line from STDIN')
     if field_number_present:
         parser.add_argument('field_number', type=int, default=field_number)
-    parser.add_argument('data_type', choices=ENCODERS.keys(), default='bytes')
+    parser.add_argument('data_type', choices=encoders.keys(), default='bytes')
     parser.add_argument('values', nargs='*')
 
     args = parser.parse_args()
 
-    if len(args.values) == 0:
-        value = ensure_binary(sys.stdin).read()
-    elif len(args.values) == 1:
-        value = args.values[0]
-    else:
-        value = args.values
-
     if field_number_present:
         field_number = args.field_number
 
-    msg = encode_message(field_number, args.data_type, value)
-    ensure_binary(sys.stdout).write(msg)
-
+    return field_number, args.data_type, args.values
 
-def grpc_frame():
-    from .grpc_frame import wrap_grpc_stream, encode_grpc_frame, \
-        unwrap_grpc_stream, pipe_unwrap_grpc_frame
 
-    import argparse, sys
+def parse_grpc_frame_args():
+    import argparse
+    from .grpc_frame import COMPRESSION_WBITS, DEFAULT_COMPRESSION_THRESHOLD
 
     parser = argparse.ArgumentParser(description='Wrap / unwrap protobufs to GRPC frames')
     parser.add_argument('command', choices=['wrap', 'unwrap'])
     parser.add_argument('--stream', action='store_true')
     parser.add_argument('--tag', type=int, default=1)
+    parser.add_argument('--compression', choices=sorted(COMPRESSION_WBITS.keys()),
+        help="compress wrapped messages (unwrap decompresses automatically)")
+    parser.add_argument('--compression_threshold', type=int, default=DEFAULT_COMPRESSION_THRESHOLD,
+        help="only compress messages of at least this many bytes")
+    parser.add_argument('--stats', action='store_true',
+        help="print the --stream frame size distribution as JSON to STDERR")
     #parser.add_argument('--wire_type', type=int, default=LENGTH_DELIM)
 
     args = parser.parse_args()
+    if args.stats and not args.stream:
+        parser.error('--stats requires --stream')
+    return args
+
+def grpc_frame():
+    from .grpc_frame import wrap_grpc_stream, encode_grpc_frame, \
+        unwrap_grpc_stream, pipe_unwrap_grpc_frame, FrameCompressor
+    import sys
+
+    args = parse_grpc_frame_args()
+    stats = None
+    if args.stats:
+        from .stats import DecodeStats
+        stats = DecodeStats()
 
     in_stream = ensure_binary(sys.stdin)
     out_stream = ensure_binary(sys.stdout)
 
+    compressor = None
+    if args.compression:
+        compressor = FrameCompressor(args.compression, args.compression_threshold)
+
     if args.command == 'wrap':
         if args.stream:
-            wrap_grpc_stream(in_stream, out_stream)
+            wrap_grpc_stream(in_stream, out_stream, compressor, stats)
         else:
-            out_stream.write(encode_grpc_frame(in_stream.read()))
+            out_stream.write(encode_grpc_frame(in_stream.read(), compressor))
     elif args.command == 'unwrap':
         if args.stream:
-            unwrap_grpc_stream(in_stream, out_stream, args.tag)
+            unwrap_grpc_stream(in_stream, out_stream, args.tag, stats)
         else:
             pipe_unwrap_grpc_frame(in_stream, out_stream)
 
+    if stats is not None:
+        import json
+        sys.stderr.write(json.dumps(stats.as_dict().get('frames', {}), indent=2, sort_keys=True) + '\n')
+
 
 def grpc_client():
     from .grpc_frame import encode_message, protobuf_stream_gen
+    from .grpc_client import create_call, split_url, batch_client
     # pylint: disable=E0401
     import grpc
 
@@ -80,28 +200,26 @@ def grpc_client():
         parser.add_argument('-is', '--stream_request', action='store_true')
         parser.add_argument('-os', '--stream_response', action='store_true')
         parser.add_argument('--tag', type=int, default=1)
+        parser.add_argument('--batch', action='store_true',
+            help="input is a length-delimited collection of requests, one call per request")
+        parser.add_argument('--concurrency', type=int, default=8,
+            help="maximum number of concurrent calls in --batch mode")
+        parser.add_argument('--channels', type=int, default=1,
+            help="number of reused channels in --batch mode")
+        parser.add_argument('--unordered', action='store_true',
+            help="write --batch responses as they complete")
+        parser.add_argument('--stats', action='store_true',
+            help="print throughput, latency percentiles and errors of --batch calls to STDERR")
         parser.add_argument('url')
 
         return parser.parse_args()
 
-    def mode_name(is_stream):
-        if is_stream:
-            return 'stream'
-        return 'unary'
-
     def client(in_stream, out_stream, args):
-        host, _, path = args.url.partition('/')
+        host, path = split_url(args.url)
 
         channel = grpc.insecure_channel(host)
 
-        # e.g. unary_stream
-        mode = mode_name(args.stream_request) + '_' + mode_name(args.stream_response)
-
-        passthrough = lambda x: x
-
-        service = getattr(channel, mode)('/' + path,
-            request_serializer=passthrough,
-            response_deserializer=passthrough)
+        service = create_call(channel, path, args.stream_request, args.stream_response)
 
         if args.stream_request:
             req = protobuf_stream_gen(in_stream)
@@ -118,21 +236,252 @@ def grpc_client():
     args = parse_args()
     in_stream = ensure_binary(sys.stdin)
     out_stream = ensure_binary(sys.stdout)
-    client(in_stream, out_stream, args)
+    if args.batch:
+        import json
+        stats = batch_client(in_stream, out_stream, args.url,
+            args.stream_request, args.stream_response, args.tag,
+            args.concurrency, args.channels, not args.unordered)
+        if args.stats:
+            sys.stderr.write(json.dumps(stats, sort_keys=True) + '\n')
+    else:
+        client(in_stream, out_stream, args)
+
+def grpc_bench():
+    import argparse, json, sys
+    from .grpc_frame import protobuf_stream_gen
+    from .grpc_bench import run_benchmark, summarize, write_histogram
+
+    parser = argparse.ArgumentParser(description='GRPC load generator')
+    parser.add_argument('-is', '--stream_request', action='store_true')
+    parser.add_argument('-os', '--stream_response', action='store_true')
+    parser.add_argument('--requests', help="length-delimited collection of requests, replayed in a loop (default: STDIN)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds")
+    parser.add_argument('--calls', type=int, help="stop after this many calls (default: run for --duration)")
+    parser.add_argument('--concurrency', type=int, default=8, help="maximum number of concurrent calls")
+    parser.add_argument('--qps', type=float, help="target calls per second (default: as fast as possible)")
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--histogram', help="write the latency histogram to this file (lower_ms upper_ms count)")
+    parser.add_argument('url')
+    args = parser.parse_args()
 
-def pw_decode():
+    if args.requests:
+        with open(args.requests, 'rb') as f:
+            requests = list(protobuf_stream_gen(f))
+    else:
+        requests = list(protobuf_stream_gen(ensure_binary(sys.stdin)))
+
+    histogram, errors, elapsed = run_benchmark(args.url, requests,
+        args.stream_request, args.stream_response, args.duration,
+        args.concurrency, args.qps, args.channels, args.calls)
+
+    if args.histogram:
+        with open(args.histogram, 'wb') as f:
+            write_histogram(histogram, f)
+    print(json.dumps(summarize(histogram, elapsed, errors), indent=2, sort_keys=True))
+
+def pw_filter():
+    import argparse, sys
+    from .filtering import compile_predicate, filter_buffer, filter_stream
+    from .proto_decoding import mapped_file
+
+    parser = argparse.ArgumentParser(
+        description='Write the elements of a length-delimited collection that match all conditions',
+        epilog="""Conditions are PATH:TYPE OP VALUE, where PATH is a dot-separated list of
+            field numbers inside the element and OP one of = != < <= > >= ^= (prefix), e.g.,
+            '3:string=hello' '2.1:int>=10'. Repeated fields match if any value matches.""")
+    parser.add_argument('conditions', nargs='+')
+    parser.add_argument('--file', help="memory-map input from this file instead of reading STDIN")
+    parser.add_argument('--field', type=int, help="only elements with this field number")
+    parser.add_argument('--limit', type=int, help="stop after this many matches")
+    parser.add_argument('--count', action='store_true', help="print the number of matches instead")
+    args = parser.parse_args()
+
+    predicate = compile_predicate(args.conditions)
+
+    out_stream = None if args.count else ensure_binary(sys.stdout)
+    if args.file:
+        n_matches = 0
+        with mapped_file(args.file) as buf:
+            for element in filter_buffer(buf, predicate, args.field, args.limit):
+                if out_stream is not None:
+                    out_stream.write(element)
+                n_matches += 1
+    else:
+        n_matches = filter_stream(ensure_binary(sys.stdin), out_stream, predicate, args.field, args.limit)
+
+    if args.count:
+        print(n_matches)
+
+def pw_decode_raw(args):
     import json, sys
-    from .proto_decoding import parse_stream_with_spec, parse_spec
+    from .proto_decoding import mapped_file, protobuf_stream_gen, parse_buffer
+    from .inspection import inspect
+
+    opts = { 'sort_keys': True, 'separators': (',', ':') }
+    if args.pretty: opts = { 'sort_keys': True, 'indent': 2 }
+
+    def write(data):
+        sys.stdout.write(json.dumps(inspect(data, args.max_depth), **opts) + '\n')
+
+    if args.file:
+        with mapped_file(args.file) as buf:
+            if args.stream:
+                for msg, _, _ in parse_buffer(buf):
+                    write(msg)
+            else:
+                write(buf)
+    elif args.stream:
+        for msg in protobuf_stream_gen(ensure_binary(sys.stdin)):
+            write(msg)
+    else:
+        write(ensure_binary(sys.stdin).read())
 
-    def parse_args():
-        import argparse
-        parser = argparse.ArgumentParser(description='Parse protobuf messages with minimal spec')
-        parser.add_argument('spec', help="For example: 2:string,3:{2:float,4:[1:sfixed32]}")
-        parser.add_argument('--pretty', action='store_true')
-        return parser.parse_args()
+def pw_decode_export(args, spec):
+    import sys
+    from .proto_decoding import mapped_file, protobuf_stream_gen, parse_buffer
+    from .columnar import export_columns, CsvWriter, ColumnarWriter
 
-    args = parse_args()
-    parsed = parse_stream_with_spec(ensure_binary(sys.stdin), parse_spec(args.spec))
+    if args.export == 'csv':
+        writer = CsvWriter(sys.stdout)
+    else:
+        writer = ColumnarWriter(ensure_binary(sys.stdout))
+
+    if args.file:
+        with mapped_file(args.file) as buf:
+            messages = (msg for msg, _, _ in parse_buffer(buf))
+            export_columns(messages, spec, writer, args.chunk_rows)
+    else:
+        export_columns(protobuf_stream_gen(ensure_binary(sys.stdin)), spec, writer, args.chunk_rows)
+
+def parse_pw_decode_args():
+    import argparse
+    parser = argparse.ArgumentParser(description='Parse protobuf messages with minimal spec')
+    parser.add_argument('spec', nargs='?', help="For example: 2:string,3:{2:float,4:[1:sfixed32]}")
+    parser.add_argument('--spec_file', help="read the spec from a file written with --save_spec")
+    parser.add_argument('--save_spec', metavar='FILE',
+        help="save the parsed spec to FILE (for --spec_file) and exit without decoding")
+    parser.add_argument('--raw', action='store_true',
+        help="decode without a spec, guessing which payloads are nested messages")
+    parser.add_argument('--max_depth', type=int, default=32,
+        help="maximum nesting depth of --raw messages")
+    parser.add_argument('--pretty', action='store_true')
+    parser.add_argument('--file', help="memory-map input from this file instead of reading STDIN")
+    parser.add_argument('--stream', action='store_true',
+        help="input is a length-delimited collection, write one JSON line per element")
+    parser.add_argument('--jobs', type=int, default=1,
+        help="decode top-level entries in this many parallel processes")
+    parser.add_argument('--stats', action='store_true',
+        help="print field sizes, decoding times and the largest payloads as JSON to STDERR")
+    parser.add_argument('--export', choices=['csv', 'columnar'],
+        help="write the scalar fields of each element of a length-delimited collection " +
+            "as a row of a CSV or binary columnar table")
+    parser.add_argument('--chunk_rows', type=int, default=64 * 1024,
+        help="rows buffered in memory per written chunk with --export")
+    args = parser.parse_args()
+    if args.stream and args.pretty:
+        parser.error('--pretty cannot be used with --stream')
+    if args.stats and args.jobs > 1:
+        parser.error('--stats cannot be used with --jobs')
+    if args.raw and (args.spec or args.spec_file or args.jobs > 1 or args.stats):
+        parser.error('--raw cannot be used with a spec, --jobs or --stats')
+    if args.spec and args.spec_file:
+        parser.error('the spec and --spec_file cannot be used together')
+    if not args.raw and not args.spec and not args.spec_file:
+        parser.error('a spec, --spec_file or --raw is required')
+    if args.save_spec and not args.spec:
+        parser.error('--save_spec requires a spec')
+    if args.export and (args.raw or args.jobs > 1 or args.stats or args.pretty):
+        parser.error('--export cannot be used with --raw, --jobs, --stats or --pretty')
+    if args.chunk_rows < 1:
+        parser.error('--chunk_rows must be positive')
+    return args
+
+# decoded message, or an iterator of the decoded elements with --stream
+def pw_decode_parallel(args, spec):
+    import sys
+    from . import parallel
+    if args.file:
+        if args.stream:
+            return parallel.parse_file_collection_with_spec_parallel(args.file, spec, args.jobs)
+        return parallel.parse_file_with_spec_parallel(args.file, spec, args.jobs)
+    data = ensure_binary(sys.stdin).read()
+    if args.stream:
+        return parallel.parse_bytes_collection_with_spec_parallel(data, spec, args.jobs)
+    return parallel.parse_bytes_with_spec_parallel(data, spec, args.jobs)
+
+def pw_decode_sequential(args, spec):
+    import sys
+    from .proto_decoding import parse_stream_with_spec, parse_file_with_spec, \
+        parse_collection_with_spec, parse_file_collection_with_spec
+    if args.file:
+        if args.stream:
+            return parse_file_collection_with_spec(args.file, spec)
+        return parse_file_with_spec(args.file, spec)
+    if args.stream:
+        return parse_collection_with_spec(ensure_binary(sys.stdin), spec)
+    return parse_stream_with_spec(ensure_binary(sys.stdin), spec)
+
+def pw_decode():
+    import json, sys
+    from .proto_decoding import parse_spec, compile_spec, load_spec, save_spec
+
+    args = parse_pw_decode_args()
+    if args.raw:
+        pw_decode_raw(args)
+        return
+    if args.save_spec:
+        save_spec(args.spec, args.save_spec)
+        return
+    spec = load_spec(args.spec_file) if args.spec_file else parse_spec(args.spec)
+    if args.export:
+        pw_decode_export(args, spec)
+        return
+    stats = None
+    if args.stats:
+        from .stats import DecodeStats
+        stats = DecodeStats()
+        spec = compile_spec(spec, stats=stats)
     opts = { 'sort_keys': True }
     if args.pretty: opts['indent'] = 2
-    print(json.dumps(parsed, **opts))
+
+    if args.jobs > 1:
+        decoded = pw_decode_parallel(args, spec)
+    else:
+        decoded = pw_decode_sequential(args, spec)
+
+    if args.stream:
+        for element in decoded:
+            sys.stdout.write(json.dumps(element, **opts) + '\n')
+            sys.stdout.flush()
+    else:
+        print(json.dumps(decoded, **opts))
+
+    if stats is not None:
+        sys.stderr.write(json.dumps(stats.as_dict(), indent=2, sort_keys=True) + '\n')
+
+def pw_encode():
+    import argparse, sys
+    from .proto_decoding import parse_spec, load_spec
+    from .spec_encoding import encode_records, read_json_records, FLUSH_SIZE
+
+    parser = argparse.ArgumentParser(
+        description='Encode JSON objects (one per line or a JSON array) with a minimal spec')
+    parser.add_argument('spec', nargs='?', help="For example: 2:string,3:{2:float,4:[1:sfixed32]}")
+    parser.add_argument('--spec_file', help="read the spec from a file written with pw-decode --save_spec")
+    parser.add_argument('--grpc', action='store_true',
+        help="write a GRPC frame stream instead of a length-delimited collection")
+    parser.add_argument('--tag', type=int, default=1,
+        help="field number of the elements in the output collection")
+    args = parser.parse_args()
+    if bool(args.spec) == bool(args.spec_file):
+        parser.error('either a spec or --spec_file is required')
+    if args.grpc and args.tag != 1:
+        parser.error('--tag cannot be used with --grpc')
+
+    if args.spec_file:
+        spec = load_spec(args.spec_file)
+    else:
+        spec = parse_spec(args.spec)
+    out_stream = ensure_binary(sys.stdout)
+    encode_records(read_json_records(sys.stdin), out_stream, spec, grpc=args.grpc, tag=args.tag,
+        flush_size=FLUSH_SIZE if is_regular_file(out_stream) else 0)
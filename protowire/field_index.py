@@ -0,0 +1,202 @@
+# Index of the top-level entries of a (large) protobuf message or collection
+# for random access without re-parsing. The index is stored in a sidecar
+# file: a header followed by one little-endian column per attribute
+import array
+import struct
+import sys
+import zlib
+
+from .proto_decoding import index_buffer, mapped_file, read_varint_from_buffer, \
+    packed_array_typecode, as_buffer
+from .wire_type import VARINT
+
+MAGIC = b'PWIDX002'
+# magic, number of entries, size of the indexed data and its fingerprint
+HEADER_FORMAT = '<8sQQQQI'
+
+# bytes from both ends of the data included in the fingerprint checksum
+CHECKSUM_SIZE = 4096
+
+SIDECAR_SUFFIX = '.pwidx'
+
+COLUMNS = ('field_numbers', 'wire_types', 'offsets', 'lengths')
+
+COLUMN_TYPECODES = {
+    'field_numbers': packed_array_typecode('fixed32'),
+    'wire_types': 'B',
+    'offsets': packed_array_typecode('fixed64'),
+    'lengths': packed_array_typecode('fixed64')
+}
+
+# (modification time in ns, inode, checksum of the first and last bytes)
+# of the indexed data, the time and inode are 0 if it is not a file. An
+# index is stale if the data size or any of these do not match
+def data_fingerprint(data, stat=None):
+    head = bytes(data[:CHECKSUM_SIZE])
+    tail = bytes(data[max(CHECKSUM_SIZE, len(data) - CHECKSUM_SIZE):])
+    checksum = zlib.crc32(tail, zlib.crc32(head)) & 0xffffffff
+    if stat is None:
+        return (0, 0, checksum)
+    mtime_ns = getattr(stat, 'st_mtime_ns', None) # Python 3
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1e9)
+    return (mtime_ns, stat.st_ino, checksum)
+
+class FieldIndex(object):
+    def __init__(self, data_size, columns=None, fingerprint=(0, 0, 0)):
+        self.data_size = data_size
+        self.fingerprint = fingerprint
+        if columns is None:
+            columns = dict((name, array.array(COLUMN_TYPECODES[name])) for name in COLUMNS)
+        self.field_numbers = columns['field_numbers']
+        self.wire_types = columns['wire_types']
+        self.offsets = columns['offsets']
+        self.lengths = columns['lengths']
+        self.entries_by_field = None
+
+    @staticmethod
+    def build(data, stat=None):
+        index = FieldIndex(len(data), fingerprint=data_fingerprint(data, stat))
+        add_field, add_wire_type = index.field_numbers.append, index.wire_types.append
+        add_offset, add_length = index.offsets.append, index.lengths.append
+        for field_number, wire_type, offset, length in index_buffer(data):
+            add_field(field_number)
+            add_wire_type(wire_type)
+            add_offset(offset)
+            add_length(length)
+        return index
+
+    @staticmethod
+    def build_file(path):
+        import os
+        with mapped_file(path) as buf:
+            return FieldIndex.build(buf, os.stat(path))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def entry(self, n):
+        return (self.field_numbers[n], self.wire_types[n], self.offsets[n], self.lengths[n])
+
+    # entry numbers of one field, computed once on first use
+    def field_entries(self, field_number):
+        if self.entries_by_field is None:
+            by_field = {}
+            for n, f in enumerate(self.field_numbers):
+                if f not in by_field:
+                    by_field[f] = array.array(COLUMN_TYPECODES['offsets'])
+                by_field[f].append(n)
+            self.entries_by_field = by_field
+        return self.entries_by_field.get(field_number, [])
+
+    # written to a temporary file next to it and renamed into place, so
+    # readers never see a partially written index
+    def save(self, path):
+        import os, tempfile
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack(HEADER_FORMAT, MAGIC, len(self), self.data_size, *self.fingerprint))
+                for column in (self.field_numbers, self.wire_types, self.offsets, self.lengths):
+                    if sys.byteorder != 'little':
+                        column = array.array(column.typecode, column)
+                        column.byteswap()
+                    column.tofile(f)
+            os.chmod(temp_path, 0o644) # mkstemp creates it readable by the owner only
+            getattr(os, 'replace', os.rename)(temp_path, path) # no os.replace on Python 2
+        except:
+            os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def load(path):
+        import os
+        with open(path, 'rb') as f:
+            header = f.read(struct.calcsize(HEADER_FORMAT))
+            if len(header) != struct.calcsize(HEADER_FORMAT):
+                raise RuntimeError("not a protowire index file: " + path)
+            magic, n_entries, data_size, mtime_ns, inode, checksum = struct.unpack(HEADER_FORMAT, header)
+            if magic != MAGIC:
+                raise RuntimeError("not a protowire index file (or an older version): " + path)
+            entry_size = sum(array.array(COLUMN_TYPECODES[name]).itemsize for name in COLUMNS)
+            if os.fstat(f.fileno()).st_size != len(header) + n_entries * entry_size:
+                raise RuntimeError("truncated or corrupt protowire index file: " + path)
+            columns = {}
+            error = None
+            try:
+                for name in COLUMNS:
+                    column = array.array(COLUMN_TYPECODES[name])
+                    column.fromfile(f, n_entries)
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    columns[name] = column
+            except (EOFError, ValueError) as e:
+                error = e
+            if error is not None:
+                raise RuntimeError("truncated or corrupt protowire index file: " + path + ": " + str(error))
+        return FieldIndex(data_size, columns, (mtime_ns, inode, checksum))
+
+def decode_entry(buf, field_number, wire_type, offset, length):
+    if wire_type == VARINT:
+        return read_varint_from_buffer(buf, offset)[0], field_number, wire_type
+    return buf[offset:offset+length], field_number, wire_type
+
+# random access to the entries of a memory-mapped file, the index is loaded
+# from (or built and saved to) the sidecar file next to it
+class IndexedFile(object):
+    def __init__(self, path, index_path=None, save_index=True):
+        import mmap, os
+        if index_path is None:
+            index_path = path + SIDECAR_SUFFIX
+        self.mapping = None
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size > 0:
+                self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = as_buffer(self.mapping if self.mapping is not None else b'')
+        self.index = None
+        if os.path.exists(index_path):
+            try:
+                self.index = FieldIndex.load(index_path)
+            except RuntimeError:
+                pass # another format version, rebuilt
+        if self.index is not None and (self.index.data_size != len(self.buffer) or
+                self.index.fingerprint != data_fingerprint(self.buffer, stat)):
+            self.index = None # stale
+        if self.index is None:
+            self.index = FieldIndex.build(self.buffer, stat)
+            if save_index:
+                try:
+                    self.index.save(index_path)
+                except (IOError, OSError):
+                    pass # e.g., a read-only directory, the index is rebuilt next time
+
+    def __len__(self):
+        return len(self.index)
+
+    # the n-th top-level entry as (msg, field_number, wire_type) like parse_buffer
+    def __getitem__(self, n):
+        return decode_entry(self.buffer, *self.index.entry(n))
+
+    def field(self, field_number):
+        for n in self.index.field_entries(field_number):
+            yield self[n]
+
+    def field_entry(self, field_number, n):
+        return self[self.index.field_entries(field_number)[n]]
+
+    def close(self):
+        self.buffer = None
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass # entries still referenced, unmapped when collected
+            self.mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
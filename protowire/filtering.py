@@ -0,0 +1,212 @@
+# Filtering length-delimited collections on the raw wire data: each element
+# is tested by scanning only the entry headers on the paths of the
+# conditions, decoding just the values they compare, and matching elements
+# are written out as is (header and payload bytes of the input).
+#
+# A condition is "PATH:TYPE OP VALUE", e.g., 3:string=hello, 2.1:int>=10 or
+# 4:bytes^=prefix, where PATH is a dot-separated list of field numbers inside
+# the element and OP one of = != < <= > >= ^= (prefix). A condition matches
+# if any value at the path (repeated fields, packed values, repeated parent
+# messages) satisfies it. Absent fields and payloads on the path that are
+# not valid messages do not match any condition.
+import operator
+import re
+
+from .proto_decoding import DECODERS, WIRE_TYPES, StreamParser, as_buffer, \
+    read_varint_from_buffer, parse_entry_bounds, parse_length_delimited_bounds, packed_decoder
+from .grpc_frame import ChunkReader, WriteBuffer
+from .wire_type import VARINT, LENGTH_DELIM
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+CONDITION_SYNTAX = re.compile(r'^([0-9]+(?:\.[0-9]+)*):([a-z0-9]+)(!=|<=|>=|\^=|=|<|>)(.*)$', re.DOTALL)
+
+FLOAT_TYPES = ('float', 'double')
+BYTES_TYPES = ('string', 'bytes')
+
+def parse_value(text, proto_type):
+    if proto_type in FLOAT_TYPES:
+        return float(text)
+    if proto_type == 'bool':
+        return text.lower() == 'true'
+    if proto_type in BYTES_TYPES:
+        # compared to the raw payload bytes
+        return text.encode('utf-8') if not isinstance(text, bytes) else text
+    if proto_type == 'hex':
+        return text.lower()
+    return int(text)
+
+# a length-delimited payload on the path of a condition that does not parse
+# as a message, unlike other errors it only means that the path is absent
+class InvalidMessage(RuntimeError):
+    pass
+
+class Condition(object):
+    def __init__(self, path, proto_type, op, value):
+        if proto_type not in DECODERS:
+            raise RuntimeError("invalid type " + proto_type)
+        if op not in OPERATORS and op != '^=':
+            raise RuntimeError("invalid operator " + op)
+        if op == '^=' and proto_type not in BYTES_TYPES + ('hex',):
+            raise RuntimeError("prefix conditions need a string, bytes or hex field")
+        self.path = [int(f) for f in path]
+        self.proto_type = proto_type
+        self.wire_type = WIRE_TYPES[proto_type]
+        # raw varints for bools, compared as bool(v)
+        self.decode_packed = packed_decoder('int' if proto_type == 'bool' else proto_type)
+        value = parse_value(value, proto_type)
+        self.compare = self.compile_compare(op, value, proto_type)
+        self.test = self.compile_test(proto_type, op, value, self.compare)
+
+    # on decoded values
+    @staticmethod
+    def compile_compare(op, value, proto_type):
+        if op == '^=':
+            return lambda v: v.startswith(value)
+        compare = OPERATORS[op]
+        if proto_type == 'bool':
+            # any non-zero varint is true like in protobuf parsers
+            return lambda v: compare(bool(v), value)
+        return lambda v: compare(v, value)
+
+    # on raw entry values (varint ints or payload views)
+    @staticmethod
+    def compile_test(proto_type, op, value, compare):
+        if proto_type in BYTES_TYPES:
+            # compare views without copying where possible
+            if op == '=':
+                return lambda v: v == value
+            if op == '!=':
+                return lambda v: v != value
+            if op == '^=':
+                n = len(value)
+                return lambda v: v[:n] == value
+            return lambda v: compare(bytes(v))
+        if proto_type == 'bool':
+            return compare
+        decode = DECODERS[proto_type]
+        return lambda v: compare(decode(v))
+
+    # the value of an entry at the end of the path
+    def test_entry(self, buf, start, end, wire_type):
+        if wire_type == self.wire_type:
+            if wire_type == VARINT:
+                return self.test(read_varint_from_buffer(buf, start)[0])
+            return self.test(buf[start:end])
+        if wire_type == LENGTH_DELIM and self.decode_packed is not None:
+            compare = self.compare
+            for v in self.decode_packed(buf[start:end]):
+                if compare(v):
+                    return True
+        return False
+
+    # does the message in data[start:end] have a matching value
+    def matches(self, data, start=0, end=None):
+        buf = as_buffer(data)
+        if end is None:
+            end = len(buf)
+        return self.match_path(buf, start, end, 0)
+
+    def match_path(self, buf, pos, end, depth):
+        target = self.path[depth]
+        last = depth == len(self.path) - 1
+        while pos < end:
+            error = None
+            try:
+                bounds = parse_entry_bounds(buf, pos, end)
+            except RuntimeError as e: # an unsupported wire type
+                bounds, error = None, str(e)
+            if bounds is None:
+                error = error or "unexpected EOF while reading protobuf field"
+                if depth > 0:
+                    raise InvalidMessage(error)
+                raise RuntimeError(error)
+            start, pos, (field_number, wire_type) = bounds
+            if field_number != target:
+                continue
+            if last:
+                if self.test_entry(buf, start, pos, wire_type):
+                    return True
+            elif wire_type == LENGTH_DELIM:
+                try:
+                    if self.match_path(buf, start, pos, depth + 1):
+                        return True
+                except InvalidMessage:
+                    pass # a payload on the path that is not a message, e.g., a string
+        return False
+
+def parse_condition(text):
+    match = CONDITION_SYNTAX.match(text)
+    if match is None:
+        raise RuntimeError("invalid condition (expected PATH:TYPE OP VALUE): " + text)
+    path, proto_type, op, value = match.groups()
+    return Condition(path.split('.'), proto_type, op, value)
+
+# matches(buf, start, end) function that is true if all conditions match,
+# evaluated in the given order. buf is a buffer returned by as_buffer
+def compile_predicate(conditions):
+    if callable(conditions):
+        return conditions
+    conditions = [parse_condition(c) if not isinstance(c, Condition) else c for c in conditions]
+
+    def matches(buf, start, end):
+        for condition in conditions:
+            if not condition.match_path(buf, start, end, 0):
+                return False
+        return True
+    return matches
+
+# whole entries: (header start, payload end, (field number, header length))
+def parse_element_bounds(buf, pos, end):
+    bounds = parse_length_delimited_bounds(buf, pos, end)
+    if bounds is None:
+        return None
+    start, stop, field_number = bounds
+    return pos, stop, (field_number, start - pos)
+
+# Matching elements of a collection as views of the complete entries into
+# data. Only elements of field_number are tested if given
+def filter_buffer(data, conditions, field_number=None, limit=None):
+    predicate = compile_predicate(conditions)
+    buf = as_buffer(data)
+    pos = 0
+    end = len(buf)
+    n_matches = 0
+    while pos < end and (limit is None or n_matches < limit):
+        bounds = parse_element_bounds(buf, pos, end)
+        if bounds is None:
+            raise RuntimeError("unexpected EOF while reading length-delimited message")
+        start, pos, (element_field, header_length) = bounds
+        if field_number is not None and element_field != field_number:
+            continue
+        if predicate(buf, start + header_length, pos):
+            n_matches += 1
+            yield buf[start:pos]
+
+# Writes the matching elements of in_stream to out_stream or, if it is None,
+# only counts them. Returns the number of matches
+def filter_stream(in_stream, out_stream, conditions, field_number=None, limit=None):
+    predicate = compile_predicate(conditions)
+    out = WriteBuffer(out_stream) if out_stream is not None else None
+    reader = ChunkReader(in_stream, before_read=out.flush if out is not None else None)
+    parser = StreamParser(parse_element_bounds, "length-delimited message")
+    n_matches = 0
+    for element, (element_field, header_length) in reader.messages(parser):
+        if field_number is not None and element_field != field_number:
+            continue
+        if predicate(as_buffer(element), header_length, len(element)):
+            if out is not None:
+                out.write(element)
+            n_matches += 1
+            if limit is not None and n_matches >= limit:
+                break
+    if out is not None:
+        out.flush()
+    return n_matches
@@ -0,0 +1,156 @@
+# Load generator for GRPC endpoints on top of the binary calls in
+# grpc_client. Requests are replayed from a list either as fast as possible
+# with a fixed number of concurrent calls or at a target rate (QPS) for a
+# fixed duration. Requires the grpcio package.
+import itertools
+import threading
+import time
+
+from .grpc_client import split_url, create_call, call_with_bytes, summarize_calls
+
+# Log-bucketed latency histogram in the style of HdrHistogram: values are
+# counted in integer units (microseconds by default) and each power of two
+# is split into 2^(sub_bucket_bits-1) linear buckets, which bounds the
+# relative error of the recorded values to 2^-(sub_bucket_bits-1)
+class LatencyHistogram(object):
+    def __init__(self, sub_bucket_bits=7, unit=1e-6):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.unit = unit
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max_value = 0
+
+    def bucket_index(self, value):
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        return (shift << self.sub_bucket_bits) | (value >> shift)
+
+    # [lower, upper) in units
+    def bucket_range(self, index):
+        shift = index >> self.sub_bucket_bits
+        sub_bucket = index & ((1 << self.sub_bucket_bits) - 1)
+        return sub_bucket << shift, (sub_bucket + 1) << shift
+
+    def record(self, seconds):
+        value = max(0, int(seconds / self.unit))
+        index = self.bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max_value = max(self.max_value, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max_value = max(self.max_value, other.max_value)
+
+    # (lower, upper, count) in seconds for the non-empty buckets
+    def buckets(self):
+        for index in sorted(self.counts):
+            lower, upper = self.bucket_range(index)
+            yield lower * self.unit, upper * self.unit, self.counts[index]
+
+    # the upper bound of the bucket of the p:th percentile in seconds
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                upper = self.bucket_range(index)[1] - 1
+                return min(upper, self.max_value) * self.unit
+        return self.max_value * self.unit
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total * self.unit / self.count
+
+# the non-empty buckets as tab-separated lower_ms, upper_ms and count lines
+# to a binary stream
+def write_histogram(histogram, out_stream):
+    for lower, upper, count in histogram.buckets():
+        out_stream.write(('%.3f\t%.3f\t%d\n' % (lower * 1000, upper * 1000, count)).encode('utf-8'))
+
+def summarize(histogram, elapsed, errors=0):
+    def to_ms(seconds):
+        return None if seconds is None else seconds * 1000
+
+    summary = summarize_calls(histogram.count, elapsed, errors, histogram.percentile)
+    summary['mean_ms'] = to_ms(histogram.mean())
+    summary['max_ms'] = to_ms(histogram.max_value * histogram.unit if histogram.count else None)
+    return summary
+
+# Calls url with the requests (cycled) for duration seconds (or until
+# max_calls calls have been started) from concurrency threads. With qps,
+# the calls are started on a fixed schedule and the latency is measured
+# from the scheduled start time so that a stalled server is not hidden by
+# the calls it delayed (coordinated omission).
+# Returns (histogram, errors, elapsed seconds)
+def run_benchmark(url, requests, stream_request=False, stream_response=False,
+                  duration=10.0, concurrency=8, qps=None, n_channels=1, max_calls=None):
+    # pylint: disable=E0401,R0913,R0917,R0914
+    import grpc
+
+    if not requests:
+        raise RuntimeError("no requests")
+
+    host, path = split_url(url)
+    channels = [grpc.insecure_channel(host) for _ in range(n_channels)]
+    calls = [create_call(c, path, stream_request, stream_response) for c in channels]
+
+    lock = threading.Lock()
+    counter = itertools.count()
+    histograms = []
+    errors = [0]
+    start = time.time()
+    deadline = start + duration
+
+    def worker(n_worker):
+        histogram = LatencyHistogram()
+        histograms.append(histogram)
+        n_errors = 0
+        call = calls[n_worker % len(calls)]
+        while True:
+            with lock:
+                n = next(counter)
+            if max_calls is not None and n >= max_calls:
+                break
+            if qps:
+                call_start = start + n / float(qps)
+                if call_start >= deadline:
+                    break
+                delay = call_start - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                call_start = time.time()
+                if call_start >= deadline:
+                    break
+            try:
+                call_with_bytes(call, requests[n % len(requests)], stream_request, stream_response)
+                histogram.record(time.time() - call_start)
+            except grpc.RpcError:
+                n_errors += 1
+        with lock:
+            errors[0] += n_errors
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for channel in channels:
+            channel.close()
+    elapsed = time.time() - start
+
+    histogram = LatencyHistogram()
+    for h in histograms:
+        histogram.merge(h)
+    return histogram, errors[0], elapsed
@@ -0,0 +1,134 @@
+# Binary GRPC calls without generated code: requests and responses are
+# passed through as serialized protobuf bytes. Requires the grpcio package.
+import time
+
+from .protobuf import encode_message, encode_key, encode_varint
+from .proto_decoding import protobuf_stream_gen, parse_buffer
+from .wire_type import LENGTH_DELIM
+
+def mode_name(is_stream):
+    if is_stream:
+        return 'stream'
+    return 'unary'
+
+def split_url(url):
+    host, _, path = url.partition('/')
+    return host, '/' + path
+
+def create_call(channel, path, stream_request=False, stream_response=False):
+    # e.g. unary_stream
+    mode = mode_name(stream_request) + '_' + mode_name(stream_response)
+
+    passthrough = lambda x: x
+
+    return getattr(channel, mode)(path,
+        request_serializer=passthrough,
+        response_deserializer=passthrough)
+
+# the blocking call for one request: with stream_request, the request is a
+# length-delimited collection of messages and with stream_response, the
+# response is returned as one (with the given tag)
+def call_with_bytes(call, request, stream_request=False, stream_response=False, tag=1):
+    if stream_request:
+        request = (bytes(msg) for msg, _, _ in parse_buffer(request))
+    if stream_response:
+        return b''.join(encode_message(tag, "bytes", item) for item in call(request))
+    return call(request)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))
+    return sorted_values[index]
+
+# percentile_of(p) returns the p:th latency percentile in seconds or None
+def summarize_calls(calls, elapsed, errors, percentile_of):
+    summary = {
+        'calls': calls,
+        'errors': errors,
+        'seconds': elapsed,
+        'calls_per_second': calls / elapsed if elapsed > 0 else None
+    }
+    for p in (50, 90, 99, 99.9):
+        seconds = percentile_of(p)
+        summary['p%s_ms' % str(p).replace('.', '')] = None if seconds is None else seconds * 1000
+    return summary
+
+def summarize_latencies(latencies, elapsed, errors=0):
+    latencies = sorted(latencies)
+    return summarize_calls(len(latencies), elapsed, errors, lambda p: percentile(latencies, p))
+
+# Runs the calls for a sequence of requests concurrently over a pool of
+# reused channels. Yields (request number, response, latency in seconds)
+# in request order or, with ordered=False, as calls complete. The response
+# is None if the call failed with a GRPC error, the other calls continue.
+# At most 2*concurrency requests are read ahead.
+def batch_calls(requests, url, stream_request=False, stream_response=False, tag=1,
+                concurrency=8, n_channels=1, ordered=True):
+    # pylint: disable=E0401,R0913,R0917,R0914
+    import grpc
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    host, path = split_url(url)
+    channels = [grpc.insecure_channel(host) for _ in range(n_channels)]
+    calls = [create_call(c, path, stream_request, stream_response) for c in channels]
+
+    def timed_call(n, request):
+        start = time.time()
+        try:
+            response = call_with_bytes(calls[n % len(calls)], request,
+                stream_request, stream_response, tag)
+        except grpc.RpcError:
+            response = None
+        return n, response, time.time() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            for n, request in enumerate(requests):
+                pending.append(executor.submit(timed_call, n, request))
+                while len(pending) >= 2*concurrency:
+                    if ordered:
+                        yield pending.popleft().result()
+                    else:
+                        for result in pop_completed(pending):
+                            yield result
+            while pending:
+                if ordered:
+                    yield pending.popleft().result()
+                else:
+                    for result in pop_completed(pending):
+                        yield result
+    finally:
+        for channel in channels:
+            channel.close()
+
+def pop_completed(pending):
+    from concurrent.futures import wait, FIRST_COMPLETED
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        pending.remove(future)
+    return [future.result() for future in done]
+
+# requests from a length-delimited collection, responses are written to
+# out_stream as a length-delimited collection with the given tag (including
+# empty responses, also for failed calls, to keep them aligned with the
+# requests). Returns the latency summary of the successful calls with the
+# number of failed ones
+def batch_client(in_stream, out_stream, url, stream_request=False, stream_response=False,
+                 tag=1, concurrency=8, n_channels=1, ordered=True):
+    # pylint: disable=R0913,R0917
+    key = encode_key(tag, LENGTH_DELIM)
+    latencies = []
+    errors = 0
+    start = time.time()
+    for _, response, latency in batch_calls(protobuf_stream_gen(in_stream), url,
+            stream_request, stream_response, tag, concurrency, n_channels, ordered):
+        if response is None:
+            errors += 1
+            response = b''
+        else:
+            latencies.append(latency)
+        out_stream.write(key + encode_varint(len(response)) + response)
+    return summarize_latencies(latencies, time.time() - start, errors)
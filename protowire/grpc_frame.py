@@ -1,7 +1,79 @@
 #!/usr/bin/env python2
-from .protobuf import encode_message
-from .proto_decoding import read_blocking, read_gen_blocking, protobuf_stream_gen
+from .protobuf import encode_key, encode_varint
+from .proto_decoding import read_blocking, read_gen_blocking, StreamParser, \
+    parse_length_delimited_bounds
+# re-exported for the command line tools
+from .protobuf import encode_message # pylint: disable=W0611
+from .proto_decoding import protobuf_stream_gen # pylint: disable=W0611
+from .wire_type import LENGTH_DELIM
 import struct
+import sys
+import zlib
+
+DEFAULT_CHUNK_SIZE = 64*1024
+
+# compressed flag & message length
+GRPC_FRAME_HEADER = struct.Struct('>BI')
+
+# grpc-encoding values, 'deflate' is zlib-wrapped
+COMPRESSION_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+
+# detects both gzip and zlib headers
+DECOMPRESSION_WBITS = 32 + zlib.MAX_WBITS
+
+# smaller messages are not worth compressing
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# zlib in Python 2 does not accept memoryviews (and bytes(view) is its repr)
+ZLIB_NEEDS_BYTES = sys.version_info[0] < 3
+
+# Each GRPC message is compressed separately. zlib streams cannot be reset,
+# so a pristine (de)compressor is initialized once and copied for each frame
+class FrameCompressor(object):
+    def __init__(self, compression, threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 level=zlib.Z_DEFAULT_COMPRESSION):
+        if compression not in COMPRESSION_WBITS:
+            raise RuntimeError("unsupported compression " + str(compression))
+        self.template = zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS[compression])
+        self.threshold = threshold
+
+    def should_compress(self, msg):
+        return len(msg) >= self.threshold
+
+    def compress(self, msg):
+        if ZLIB_NEEDS_BYTES and isinstance(msg, memoryview):
+            msg = msg.tobytes()
+        compressor = self.template.copy()
+        return compressor.compress(msg) + compressor.flush()
+
+class FrameDecompressor(object):
+    def __init__(self):
+        self.template = zlib.decompressobj(DECOMPRESSION_WBITS)
+
+    def decompress_gen(self, chunks):
+        decompressor = self.template.copy()
+        for c in chunks:
+            if ZLIB_NEEDS_BYTES and isinstance(c, memoryview):
+                c = c.tobytes()
+            out = decompressor.decompress(c)
+            if out:
+                yield out
+        out = decompressor.flush()
+        if out:
+            yield out
+        if not getattr(decompressor, 'eof', True): # Python 3
+            raise RuntimeError("truncated compressed GRPC frame")
+
+    def decompress(self, msg):
+        return b''.join(self.decompress_gen([msg]))
+
+def get_compressor(compression):
+    if compression is None or isinstance(compression, FrameCompressor):
+        return compression
+    return FrameCompressor(compression)
 
 def encode_uint32_big_endian(v):
     return struct.pack('>I', v)
@@ -16,17 +88,28 @@ def decode_int_big_endian(bytestr):
         v = (v << 8) | b
     return v
 
-def encode_grpc_frame(msg):
+# compression: None, 'gzip', 'deflate' or a FrameCompressor
+def encode_grpc_frame(msg, compression=None):
+    compressor = get_compressor(compression)
+    if compressor is not None and compressor.should_compress(msg):
+        msg = compressor.compress(msg)
+        return b'\x01' + encode_uint32_big_endian(len(msg)) + msg
     return b'\x00' + encode_uint32_big_endian(len(msg)) + msg
 
-def unwrap_grpc_frame(in_stream):
+# compressed frames are decompressed incrementally as they are read
+def unwrap_grpc_frame(in_stream, decompressor=None):
     compressed_flag = in_stream.read(1)
     if compressed_flag == b'':
         raise EOFError('EOF')
 
-    assert(compressed_flag == b'\x00')
-    size = decode_int_big_endian(read_blocking(in_stream, 4))
-    return read_gen_blocking(in_stream, size)
+    size = struct.unpack('>I', read_blocking(in_stream, 4))[0]
+    if compressed_flag == b'\x00':
+        return read_gen_blocking(in_stream, size)
+    if compressed_flag == b'\x01':
+        if decompressor is None:
+            decompressor = FrameDecompressor()
+        return decompressor.decompress_gen(read_gen_blocking(in_stream, size))
+    raise RuntimeError("invalid GRPC compressed flag %r" % compressed_flag)
 
 def pipe_unwrap_grpc_frame(in_stream, out_stream):
     for c in unwrap_grpc_frame(in_stream):
@@ -35,14 +118,113 @@ def pipe_unwrap_grpc_frame(in_stream, out_stream):
 def read_grpc_frame(in_stream):
     return b''.join(unwrap_grpc_frame(in_stream))
 
-def wrap_grpc_stream(in_stream, out_stream):
-    for msg in protobuf_stream_gen(in_stream):
-        out_stream.write(encode_grpc_frame(msg))
-
-def unwrap_grpc_stream(in_stream, out_stream, tag=1):
-    while True:
-        try:
-            frame = read_grpc_frame(in_stream)
-            out_stream.write(encode_message(tag, "bytes", frame))
-        except EOFError:
-            break
+# Reads a stream in large chunks and feeds them to a sans-IO StreamParser,
+# which hands out messages as memoryviews into its buffer. A view is only
+# valid until the next message is read.
+class ChunkReader(object):
+    def __init__(self, in_stream, chunk_size=DEFAULT_CHUNK_SIZE, before_read=None):
+        # read1 returns what is available instead of blocking for a full chunk
+        self.read = getattr(in_stream, 'read1', in_stream.read)
+        self.chunk_size = chunk_size
+        self.before_read = before_read
+
+    def messages(self, parser):
+        while True:
+            for entry in parser.messages():
+                yield entry
+            if self.before_read is not None:
+                self.before_read()
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                parser.close()
+                return
+            parser.feed(chunk)
+
+    # (frame, compressed flag)
+    def grpc_frames(self):
+        return self.messages(grpc_frame_parser())
+
+    # (message, field number) of a length-delimited collection
+    def length_delimited_messages(self):
+        return self.messages(StreamParser(parse_length_delimited_bounds, "length-delimited message"))
+
+def parse_grpc_frame_bounds(buf, pos, end):
+    start = pos + GRPC_FRAME_HEADER.size
+    if start > end:
+        return None
+    compressed_flag, size = GRPC_FRAME_HEADER.unpack_from(buf, pos)
+    if compressed_flag > 1:
+        raise RuntimeError("invalid GRPC compressed flag %d" % compressed_flag)
+    if start + size > end:
+        return None
+    return start, start + size, compressed_flag
+
+def grpc_frame_parser():
+    return StreamParser(parse_grpc_frame_bounds, "GRPC frame")
+
+# Collects small writes to one buffer that is written out when it is full
+# or explicitly flushed, e.g., before blocking to wait for more input. Hot
+# loops may append to .buffer directly, it is reused after each flush
+class WriteBuffer(object):
+    def __init__(self, out_stream, flush_size=DEFAULT_CHUNK_SIZE):
+        self.out_stream = out_stream
+        self.flush_size = flush_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.out_stream.write(self.buffer)
+            del self.buffer[:]
+
+# shared by the blocking and asyncio stream functions
+def append_grpc_frame(buf, msg, compressor=None):
+    if compressor is not None and compressor.should_compress(msg):
+        msg = compressor.compress(msg)
+        buf += GRPC_FRAME_HEADER.pack(1, len(msg))
+    else:
+        buf += GRPC_FRAME_HEADER.pack(0, len(msg))
+    buf += msg
+
+def append_unwrapped_grpc_frame(buf, key, frame, compressed_flag, decompressor):
+    if compressed_flag:
+        frame = decompressor.decompress(frame)
+    # empty messages are default values that are not written
+    if len(frame) > 0:
+        buf += key
+        buf += encode_varint(len(frame))
+        buf += frame
+
+# stats: optional stats.DecodeStats for the message / frame sizes
+def wrap_grpc_stream(in_stream, out_stream, compression=None, stats=None):
+    compressor = get_compressor(compression)
+    out = WriteBuffer(out_stream)
+    reader = ChunkReader(in_stream, before_read=out.flush)
+    buf = out.buffer
+    messages = reader.length_delimited_messages()
+    if stats is not None:
+        messages = stats.count_frames(messages)
+    for msg, _ in messages:
+        append_grpc_frame(buf, msg, compressor)
+        if len(buf) >= out.flush_size:
+            out.flush()
+    out.flush()
+
+def unwrap_grpc_stream(in_stream, out_stream, tag=1, stats=None):
+    key = encode_key(tag, LENGTH_DELIM)
+    decompressor = FrameDecompressor()
+    out = WriteBuffer(out_stream)
+    reader = ChunkReader(in_stream, before_read=out.flush)
+    buf = out.buffer
+    frames = reader.grpc_frames()
+    if stats is not None:
+        frames = stats.count_grpc_frames(frames)
+    for frame, compressed_flag in frames:
+        append_unwrapped_grpc_frame(buf, key, frame, compressed_flag, decompressor)
+        if len(buf) >= out.flush_size:
+            out.flush()
+    out.flush()
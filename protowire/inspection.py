@@ -0,0 +1,130 @@
+# Schema-less inspection: decodes arbitrary wire data into a tree of
+# {field number: value} dicts (a list for repeated fields) by guessing which
+# length-delimited payloads are submessages. Works on views into a single
+# buffer, only the printed leaf values are copied.
+#
+# Values: varints and fixed32/64 are unsigned ints, length-delimited
+# payloads are nested dicts (valid messages), strings (printable UTF-8) or
+# {"hex": "..."} for anything else, e.g., packed repeated fields.
+import binascii
+import re
+import struct
+
+from .proto_decoding import as_buffer
+from .wire_type import VARINT, FIXED64, LENGTH_DELIM, FIXED32
+
+DEFAULT_MAX_DEPTH = 32
+
+MAX_FIELD_NUMBER = (1 << 29) - 1
+MAX_VARINT_BYTES = 10
+
+CONTROL_CHARACTERS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+def read_bounded_varint(buf, pos, end):
+    value = 0
+    for shift in range(0, 7 * MAX_VARINT_BYTES, 7):
+        if pos >= end:
+            break
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+    return None, pos
+
+# (varint value, payload start, payload end) of an entry with wire_type
+# whose payload starts at pos, None if it does not fit in buf[:end]
+def scan_payload(buf, pos, end, wire_type):
+    value = None
+    if wire_type == VARINT:
+        value, next_pos = read_bounded_varint(buf, pos, end)
+        if value is None:
+            return None
+    elif wire_type == LENGTH_DELIM:
+        length, pos = read_bounded_varint(buf, pos, end)
+        if length is None:
+            return None
+        next_pos = pos + length
+    elif wire_type == FIXED32:
+        next_pos = pos + 4
+    elif wire_type == FIXED64:
+        next_pos = pos + 8
+    else:
+        return None # groups are not supported
+    if next_pos > end:
+        return None
+    return value, pos, next_pos
+
+# The top-level entries of buf[start:end] as (field_number, wire_type,
+# payload start, payload end, varint value) or None if it is not a valid
+# message. Only the headers are read and the check stops at the first
+# invalid tag or length
+def scan_message(buf, start, end):
+    entries = []
+    pos = start
+    while pos < end:
+        tag, pos = read_bounded_varint(buf, pos, end)
+        if tag is None:
+            return None
+        field_number = tag >> 3
+        if field_number == 0 or field_number > MAX_FIELD_NUMBER:
+            return None
+        payload = scan_payload(buf, pos, end, tag & 0x7)
+        if payload is None:
+            return None
+        value, pos, next_pos = payload
+        entries.append((field_number, tag & 0x7, pos, next_pos, value))
+        pos = next_pos
+    return entries
+
+def as_text(buf, start, end):
+    try:
+        text = bytes(buf[start:end]).decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if CONTROL_CHARACTERS.search(text):
+        return None
+    return text
+
+# Printable text can also be a valid message, e.g., a submessage with a
+# string in field 1 starts with a newline and the string length. Like protoc
+# --decode_raw, such payloads are shown as messages, but only if they have
+# length-delimited fields: text like 'xx' (field 15 = 120) stays text
+def inspect_payload(buf, start, end, depth, max_depth):
+    entries = None
+    if depth < max_depth:
+        entries = scan_message(buf, start, end)
+    if not entries or all(entry[1] != LENGTH_DELIM for entry in entries):
+        text = as_text(buf, start, end)
+        if text is not None:
+            return text
+    if entries is not None:
+        return inspect_entries(buf, entries, depth + 1, max_depth)
+    return {'hex': binascii.hexlify(bytes(buf[start:end])).decode('utf-8')}
+
+def inspect_entries(buf, entries, depth, max_depth):
+    result = {}
+    for field_number, wire_type, start, end, value in entries:
+        if wire_type == LENGTH_DELIM:
+            value = inspect_payload(buf, start, end, depth, max_depth)
+        elif wire_type == FIXED32:
+            value = struct.unpack_from('<I', buf, start)[0]
+        elif wire_type == FIXED64:
+            value = struct.unpack_from('<Q', buf, start)[0]
+        key = str(field_number)
+        if key not in result:
+            result[key] = value
+        elif isinstance(result[key], list):
+            result[key].append(value)
+        else:
+            result[key] = [result[key], value]
+    return result
+
+# the tree of a complete message, nested messages deeper than max_depth are
+# returned as hex
+def inspect(data, max_depth=DEFAULT_MAX_DEPTH):
+    buf = as_buffer(data)
+    entries = scan_message(buf, 0, len(buf))
+    if entries is None:
+        raise RuntimeError("not a valid protobuf message")
+    return inspect_entries(buf, entries, 0, max_depth)
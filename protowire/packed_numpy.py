@@ -0,0 +1,85 @@
+# Vectorized packed field encoding & decoding, requires the optional numpy
+# dependency (pip install protowire[numpy]). Only imported when numpy arrays
+# are passed to encode_message or requested with compile_spec(...,
+# packed_arrays='numpy').
+# pylint: disable=E0401
+import numpy
+
+FIXED_DTYPES = {
+    "float": '<f4',
+    "double": '<f8',
+    "fixed32": '<u4',
+    "fixed64": '<u8',
+    "sfixed32": '<i4',
+    "sfixed64": '<i8'
+}
+
+VARINT_TYPES = ("bool", "int", "int32", "int64", "sint32", "sint64")
+
+MAX_VARINT_BYTES = 10
+
+def to_varint_values(values, proto_type):
+    values = numpy.asarray(values)
+    if proto_type in ("sint32", "sint64"):
+        values = values.astype(numpy.int64)
+        return ((values << 1) ^ (values >> 63)).view(numpy.uint64)
+    if proto_type == "bool":
+        return values.astype(bool).astype(numpy.uint64)
+    # negative ints are encoded in two's complement as 64-bit values
+    return values.astype(numpy.int64).view(numpy.uint64)
+
+def encode_varints(values):
+    n_bytes = numpy.ones(len(values), dtype=numpy.intp)
+    for k in range(1, MAX_VARINT_BYTES):
+        n_bytes += values >= numpy.uint64(1 << (7*k))
+    ends = numpy.cumsum(n_bytes)
+    starts = ends - n_bytes
+    out = numpy.empty(int(ends[-1]) if len(ends) > 0 else 0, dtype=numpy.uint8)
+    for k in range(int(n_bytes.max()) if len(n_bytes) > 0 else 0):
+        mask = n_bytes > k
+        groups = (values[mask] >> numpy.uint64(7*k)) & numpy.uint64(0x7f)
+        more = (n_bytes[mask] > k + 1).astype(numpy.uint64) << numpy.uint64(7)
+        out[starts[mask] + k] = groups | more
+    return out.tobytes()
+
+def decode_varints(value):
+    data = numpy.frombuffer(value, dtype=numpy.uint8)
+    ends = numpy.flatnonzero(data < 0x80)
+    if len(data) > 0 and (len(ends) == 0 or ends[-1] != len(data) - 1):
+        raise RuntimeError("unexpected end of packed varints")
+    starts = numpy.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    n_bytes = ends - starts + 1
+    if len(n_bytes) > 0 and n_bytes.max() > MAX_VARINT_BYTES:
+        raise RuntimeError("invalid varint in packed field")
+    values = numpy.zeros(len(ends), dtype=numpy.uint64)
+    for k in range(int(n_bytes.max()) if len(n_bytes) > 0 else 0):
+        mask = n_bytes > k
+        groups = (data[starts[mask] + k] & 0x7f).astype(numpy.uint64)
+        values[mask] |= groups << numpy.uint64(7*k)
+    return values
+
+def encode_packed(proto_type, values):
+    if proto_type in FIXED_DTYPES:
+        return numpy.asarray(values).astype(FIXED_DTYPES[proto_type]).tobytes()
+    if proto_type in VARINT_TYPES:
+        return encode_varints(to_varint_values(values, proto_type))
+    raise RuntimeError("cannot encode %s from a numpy array" % proto_type)
+
+def decode_packed(value, proto_type):
+    if proto_type in FIXED_DTYPES:
+        dtype = numpy.dtype(FIXED_DTYPES[proto_type])
+        if len(value) % dtype.itemsize != 0:
+            raise RuntimeError("invalid packed %s length %d" % (proto_type, len(value)))
+        # a read-only view into the input buffer, no copies
+        return numpy.frombuffer(value, dtype=dtype)
+    values = decode_varints(value)
+    if proto_type in ("sint32", "sint64"):
+        return (values >> numpy.uint64(1)).view(numpy.int64) ^ -(values & numpy.uint64(1)).view(numpy.int64)
+    if proto_type == "bool":
+        return values.astype(bool)
+    return values
+
+def concatenate(values, more):
+    return numpy.concatenate([numpy.asarray(values), numpy.asarray(more)])
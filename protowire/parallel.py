@@ -0,0 +1,95 @@
+# Multi-process decoding of large inputs: a cheap index pass over the
+# top-level tags and lengths splits the input into contiguous chunks, which
+# are decoded in worker processes and merged in the original order.
+# Specs must be plain parse_spec dicts (compiled specs cannot be pickled).
+from .proto_decoding import compile_spec, index_buffer, mapped_file, parse_buffer, extend_values
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None # Python 2 without the futures backport, decoded sequentially
+
+# more chunks than workers to balance uneven entry sizes
+CHUNKS_PER_JOB = 4
+
+def chunk_ranges(buf, n_chunks):
+    target_size = max(1, len(buf) // n_chunks)
+    ranges = []
+    start = 0
+    for _, _, offset, length in index_buffer(buf):
+        end = offset + length
+        if end - start >= target_size:
+            ranges.append((start, end))
+            start = end
+    if start < len(buf):
+        ranges.append((start, len(buf)))
+    return ranges
+
+def decode_chunk(buf, spec, collection):
+    decoder = compile_spec(spec)
+    if collection:
+        return [decoder.decode_bytes(msg) for msg, _, _ in parse_buffer(buf)]
+    return decoder.decode_bytes(buf)
+
+def decode_file_chunk(path, start, end, spec, collection):
+    with mapped_file(path) as buf:
+        try:
+            chunk = memoryview(buf)[start:end]
+        except TypeError:
+            chunk = buf[start:end] # Python 2 mmaps have no buffer interface
+        return decode_chunk(chunk, spec, collection)
+
+def decode_bytes_chunk(data, spec, collection):
+    return decode_chunk(data, spec, collection)
+
+# results are yielded in the order of the chunks
+def map_chunks(func, chunk_args, jobs):
+    if jobs <= 1 or len(chunk_args) <= 1 or ProcessPoolExecutor is None:
+        for args in chunk_args:
+            yield func(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(func, *args) for args in chunk_args]
+        for future in futures:
+            yield future.result()
+
+def merge_results(partials, spec):
+    # result keys of the repeated fields, the spec keys may also be ints
+    repeated = frozenset(key for key, _, _, new_values, _ in compile_spec(spec).fields.values()
+        if new_values is not None)
+    result = {}
+    for partial in partials:
+        for key, value in partial.items():
+            if key in result and key in repeated:
+                result[key] = extend_values(result[key], value)
+            else:
+                result[key] = value
+    return result
+
+def file_chunks(path, spec, jobs, collection):
+    with mapped_file(path) as buf:
+        ranges = chunk_ranges(buf, jobs * CHUNKS_PER_JOB)
+    return map_chunks(decode_file_chunk,
+        [(path, start, end, spec, collection) for start, end in ranges], jobs)
+
+def bytes_chunks(data, spec, jobs, collection):
+    ranges = chunk_ranges(data, jobs * CHUNKS_PER_JOB)
+    return map_chunks(decode_bytes_chunk,
+        [(data[start:end], spec, collection) for start, end in ranges], jobs)
+
+def parse_file_with_spec_parallel(path, spec, jobs):
+    return merge_results(file_chunks(path, spec, jobs, False), spec)
+
+def parse_bytes_with_spec_parallel(data, spec, jobs):
+    return merge_results(bytes_chunks(data, spec, jobs, False), spec)
+
+def parse_file_collection_with_spec_parallel(path, spec, jobs):
+    for elements in file_chunks(path, spec, jobs, True):
+        for element in elements:
+            yield element
+
+def parse_bytes_collection_with_spec_parallel(data, spec, jobs):
+    for elements in bytes_chunks(data, spec, jobs, True):
+        for element in elements:
+            yield element
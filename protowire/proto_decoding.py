@@ -1,8 +1,12 @@
 from .wire_type import VARINT, FIXED64, LENGTH_DELIM, FIXED32
 from .protobuf import get_python_int_struct_fmt
+import array
 import binascii
+import re
 import struct
-from io import BytesIO
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
 
 def read_gen_blocking(f, n):
     left = n
@@ -16,12 +20,16 @@ def read_gen_blocking(f, n):
 def read_blocking(f, n):
     return b''.join(read_gen_blocking(f, n))
 
-def read_varint(in_stream):
+# EOFError only at EOF before the first byte of a varint where an entry may
+# start (eof_ok), a truncated varint is a RuntimeError like in aio.read_varint
+def read_varint(in_stream, eof_ok=True):
     value = 0
     bitshift = 0
     while True:
         b = in_stream.read(1)
         if b == b'':
+            if bitshift > 0 or not eof_ok:
+                raise RuntimeError("unexpected EOF while reading varint")
             raise EOFError("EOF while reading varint")
         bits = ord(b)
         value = value | ((bits & 0x7f) << bitshift)
@@ -29,15 +37,43 @@ def read_varint(in_stream):
         if (bits & 0x80) == 0:
             return value
 
+if isinstance(memoryview(b'\x00')[0], int):
+    def as_buffer(data):
+        return memoryview(data) # Python 3
+else:
+    def as_buffer(data):
+        return bytearray(data) # Python 2, memoryview items are not ints
+
+def release_view(view):
+    try:
+        view.release()
+    except AttributeError:
+        pass # Python 2
+
+def read_varint_from_buffer(buf, pos):
+    value = 0
+    bitshift = 0
+    end = len(buf)
+    while True:
+        if pos >= end:
+            raise EOFError("EOF while reading varint")
+        bits = buf[pos]
+        pos += 1
+        value = value | ((bits & 0x7f) << bitshift)
+        bitshift += 7
+        if (bits & 0x80) == 0:
+            return value, pos
+
 def read_protobuf_message(in_stream):
     tag = read_varint(in_stream)
-    wire_type = tag & 0x7
-    field_number = tag >> 3
+    return read_payload(in_stream, tag >> 3, tag & 0x7)
+
+def read_payload(in_stream, field_number, wire_type):
     if wire_type == LENGTH_DELIM:
-        l = read_varint(in_stream)
+        l = read_varint(in_stream, False)
         msg = read_blocking(in_stream, l)
     elif wire_type == VARINT:
-        msg = read_varint(in_stream)
+        msg = read_varint(in_stream, False)
     elif wire_type == FIXED32:
         msg = read_blocking(in_stream, 4)
     elif wire_type == FIXED64:
@@ -46,6 +82,117 @@ def read_protobuf_message(in_stream):
         raise RuntimeError("unsupported wire type %d with field %d" % (wire_type, field_number))
     return (msg, field_number, wire_type)
 
+# buffer counterpart of read_protobuf_message: returns the entry and the
+# position after it, payloads are slices of buf (no copies for memoryviews)
+def read_protobuf_message_from_buffer(buf, pos):
+    tag, pos = read_varint_from_buffer(buf, pos)
+    return read_payload_from_buffer(buf, pos, tag >> 3, tag & 0x7)
+
+def read_payload_from_buffer(buf, pos, field_number, wire_type):
+    if wire_type == LENGTH_DELIM:
+        l, pos = read_varint_from_buffer(buf, pos)
+        end = pos + l
+    elif wire_type == VARINT:
+        msg, pos = read_varint_from_buffer(buf, pos)
+        return (msg, field_number, wire_type), pos
+    elif wire_type == FIXED32:
+        end = pos + 4
+    elif wire_type == FIXED64:
+        end = pos + 8
+    else:
+        raise RuntimeError("unsupported wire type %d with field %d" % (wire_type, field_number))
+    if end > len(buf):
+        raise RuntimeError("unexpected EOF while reading %d bytes" % (end - pos))
+    return (buf[pos:end], field_number, wire_type), end
+
+# Sans-IO parsing: parse_*_bounds(buf, pos, end) return (payload start,
+# payload end, header info) of the complete entry at pos or None if more
+# data is needed
+def parse_entry_bounds(buf, pos, end):
+    try:
+        tag, pos = read_varint_from_buffer(buf, pos)
+        wire_type = tag & 0x7
+        if wire_type == LENGTH_DELIM:
+            length, pos = read_varint_from_buffer(buf, pos)
+        elif wire_type == VARINT:
+            length = read_varint_from_buffer(buf, pos)[1] - pos
+        elif wire_type == FIXED32:
+            length = 4
+        elif wire_type == FIXED64:
+            length = 8
+        else:
+            raise RuntimeError("unsupported wire type %d with field %d" % (wire_type, tag >> 3))
+    except EOFError:
+        return None
+    if pos + length > end:
+        return None
+    return pos, pos + length, (tag >> 3, wire_type)
+
+# messages of a length-delimited collection, header info is the field number
+def parse_length_delimited_bounds(buf, pos, end):
+    try:
+        tag, pos = read_varint_from_buffer(buf, pos)
+        if tag & 0x7 != LENGTH_DELIM:
+            raise RuntimeError("expected a length-delimited field, got wire type %d" % (tag & 0x7))
+        size, pos = read_varint_from_buffer(buf, pos)
+    except EOFError:
+        return None
+    if pos + size > end:
+        return None
+    return pos, pos + size, tag >> 3
+
+# Buffers fed data and yields complete entries found by a parse_*_bounds
+# function as (memoryview of the payload, header info). A view is valid
+# until more data is fed or the next entry is read. Contains no I/O so that
+# blocking and asyncio readers can share it.
+class StreamParser(object):
+    def __init__(self, parse_bounds, what="message"):
+        self.parse_bounds = parse_bounds
+        self.what = what
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def available(self):
+        return len(self.buffer) - self.pos
+
+    def feed(self, data):
+        try:
+            if self.pos > 0:
+                del self.buffer[:self.pos]
+            self.buffer += data
+        except BufferError:
+            # views of earlier entries still exist, use a new buffer
+            self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+
+    def messages(self):
+        buf = self.buffer
+        end = len(buf)
+        parse_bounds = self.parse_bounds
+        view = memoryview(buf)
+        msg = None
+        try:
+            while True:
+                bounds = parse_bounds(buf, self.pos, end)
+                if bounds is None:
+                    break
+                msg = view[bounds[0]:bounds[1]]
+                self.pos = bounds[1]
+                yield msg, bounds[2]
+        finally:
+            if msg is not None:
+                release_view(msg)
+            release_view(view)
+
+    # call at EOF
+    def close(self):
+        if self.available() > 0:
+            raise RuntimeError("unexpected EOF while reading " + self.what)
+
+# Reads the entries byte by byte rather than in chunks with a StreamParser,
+# so nothing past the last entry is consumed and the payloads are plain bytes
+# that stay valid. EOF stops only between entries, a truncated trailing entry
+# raises RuntimeError like aio.parse_stream
 def parse_stream(in_stream):
     while True:
         try:
@@ -53,9 +200,159 @@ def parse_stream(in_stream):
         except EOFError:
             break
 
+def parse_buffer(data):
+    buf = as_buffer(data)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        try:
+            entry, pos = read_protobuf_message_from_buffer(buf, pos)
+        except EOFError:
+            entry = None # pos < end: a truncated varint, not the end of the entries
+        if entry is None:
+            raise RuntimeError("unexpected EOF while reading varint")
+        yield entry
+
+# Projection: entries of fields not in the fields dict are skipped by
+# advancing the position (buffers) or seeking / reading into a scratch
+# buffer (streams) without allocating their payloads
+
+SKIP_CHUNK_SIZE = 64 * 1024
+
+def skip_payload_in_buffer(buf, pos, end, field_number, wire_type):
+    if wire_type == VARINT:
+        while pos < end and buf[pos] & 0x80:
+            pos += 1
+        if pos >= end:
+            raise RuntimeError("unexpected EOF while reading varint")
+        return pos + 1
+    if wire_type == LENGTH_DELIM:
+        length, pos = read_varint_from_buffer(buf, pos)
+    elif wire_type == FIXED32:
+        length = 4
+    elif wire_type == FIXED64:
+        length = 8
+    else:
+        raise RuntimeError("unsupported wire type %d with field %d" % (wire_type, field_number))
+    if pos + length > end:
+        raise RuntimeError("unexpected EOF while reading %d bytes" % length)
+    return pos + length
+
+def parse_buffer_projected(data, fields):
+    buf = as_buffer(data)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        entry = None
+        try:
+            tag, pos = read_varint_from_buffer(buf, pos)
+            field_number = tag >> 3
+            if field_number in fields:
+                entry, pos = read_payload_from_buffer(buf, pos, field_number, tag & 0x7)
+            else:
+                pos = skip_payload_in_buffer(buf, pos, end, field_number, tag & 0x7)
+        except EOFError:
+            pos = None # a truncated varint like in parse_buffer
+        if pos is None:
+            raise RuntimeError("unexpected EOF while reading varint")
+        if entry is not None:
+            yield entry
+
+# skip(n) function for the stream: seeks if possible
+def stream_skipper(in_stream):
+    try:
+        seekable = in_stream.seekable()
+    except AttributeError:
+        seekable = False # Python 2 files
+
+    if seekable:
+        start = in_stream.tell()
+        size = in_stream.seek(0, 2)
+        in_stream.seek(start)
+        def skip(n):
+            if in_stream.seek(n, 1) > size:
+                raise RuntimeError("unexpected EOF while reading %d bytes" % n)
+        return skip
+
+    scratch = []
+    def skip_by_reading(n):
+        if not scratch:
+            scratch.append(memoryview(bytearray(SKIP_CHUNK_SIZE)))
+        view = scratch[0]
+        left = n
+        while left > 0:
+            count = in_stream.readinto(view[:min(left, SKIP_CHUNK_SIZE)])
+            if not count:
+                raise RuntimeError("unexpected EOF while reading %d bytes" % n)
+            left -= count
+
+    def skip_by_discarding(n):
+        for _ in read_gen_blocking(in_stream, n):
+            pass
+
+    if hasattr(in_stream, 'readinto'):
+        return skip_by_reading
+    return skip_by_discarding
+
+def parse_stream_projected(in_stream, fields):
+    skip = stream_skipper(in_stream)
+    while True:
+        try:
+            tag = read_varint(in_stream)
+            field_number = tag >> 3
+            wire_type = tag & 0x7
+            if field_number in fields:
+                entry = read_payload(in_stream, field_number, wire_type)
+            elif wire_type == VARINT:
+                read_varint(in_stream, False)
+                continue
+            elif wire_type == LENGTH_DELIM:
+                skip(read_varint(in_stream, False))
+                continue
+            elif wire_type == FIXED32:
+                skip(4)
+                continue
+            elif wire_type == FIXED64:
+                skip(8)
+                continue
+            else:
+                raise RuntimeError("unsupported wire type %d with field %d" % (wire_type, field_number))
+        except EOFError:
+            break
+        yield entry
+
+# (field_number, wire_type, offset, length) of each entry without touching
+# the payloads, offset and length refer to the payload (or the varint value)
+def index_buffer(data):
+    buf = as_buffer(data)
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        try:
+            tag, pos = read_varint_from_buffer(buf, pos)
+            wire_type = tag & 0x7
+            if wire_type == LENGTH_DELIM:
+                length, pos = read_varint_from_buffer(buf, pos)
+            elif wire_type == VARINT:
+                length = read_varint_from_buffer(buf, pos)[1] - pos
+            elif wire_type == FIXED32:
+                length = 4
+            elif wire_type == FIXED64:
+                length = 8
+            else:
+                raise RuntimeError("unsupported wire type %d with field %d" % (wire_type, tag >> 3))
+        except EOFError:
+            length = None # a truncated varint like in parse_buffer
+        if length is None:
+            raise RuntimeError("unexpected EOF while reading varint")
+        if pos + length > end:
+            raise RuntimeError("unexpected EOF while reading %d bytes" % length)
+        yield tag >> 3, wire_type, pos, length
+        pos += length
+
 def parse_bytes(msg_string):
-    in_stream = BytesIO(msg_string)
-    return list(parse_stream(in_stream))
+    return [(msg if wire_type == VARINT else bytes(msg), field, wire_type)
+        for msg, field, wire_type in parse_buffer(msg_string)]
 
 def decode_zigzag(value):
     v = value // 2
@@ -75,8 +372,8 @@ def decode_float(value, bits):
     return None
 
 DECODERS = {
-    "string": lambda v: v.decode('utf-8'),
-    "bytes": lambda v: v,
+    "string": lambda v: bytes(v).decode('utf-8'),
+    "bytes": bytes,
     "hex": lambda v: binascii.hexlify(v).decode('utf-8'),
     "float": lambda v: decode_float(v, 32),
     "double": lambda v: decode_float(v, 64),
@@ -110,93 +407,472 @@ WIRE_TYPES = {
     "sfixed64": FIXED64
 }
 
+# struct formats of the fixed-width types, which can be decoded in bulk
+PACKED_STRUCT_FORMATS = {
+    "float": 'f',
+    "double": 'd',
+    "fixed32": 'I',
+    "fixed64": 'Q',
+    "sfixed32": 'i',
+    "sfixed64": 'q'
+}
+
+# struct formats of the array.array items of decoded packed varints, int
+# types are unsigned like DECODERS
+PACKED_VARINT_FORMATS = {
+    "bool": 'B',
+    "int": 'Q',
+    "int32": 'Q',
+    "int64": 'Q',
+    "sint32": 'q',
+    "sint64": 'q'
+}
+
+ARRAY_TYPECODES = {}
+
+def packed_array_typecode(protobuf_type):
+    typecode = ARRAY_TYPECODES.get(protobuf_type)
+    if typecode is not None:
+        return typecode
+    fmt = PACKED_VARINT_FORMATS.get(protobuf_type) or PACKED_STRUCT_FORMATS[protobuf_type]
+    size = struct.calcsize('<' + fmt)
+    # native array item sizes vary by platform, e.g., 'L' may be 4 or 8
+    # bytes, and Python 2 has no 'q' and 'Q' arrays
+    for code in (fmt, fmt.replace('i', 'l').replace('I', 'L').replace('q', 'l').replace('Q', 'L')):
+        try:
+            if array.array(code).itemsize == size:
+                ARRAY_TYPECODES[protobuf_type] = code
+                return code
+        except ValueError:
+            pass
+    raise RuntimeError("no array type for " + protobuf_type)
+
+def decode_packed_fixed(value, protobuf_type):
+    fmt = PACKED_STRUCT_FORMATS[protobuf_type]
+    n, remainder = divmod(len(value), struct.calcsize('<' + fmt))
+    if remainder != 0:
+        raise RuntimeError("invalid packed %s length %d" % (protobuf_type, len(value)))
+    return list(struct.unpack('<%d%s' % (n, fmt), value))
+
+def decode_packed_fixed_array(value, protobuf_type):
+    arr = array.array(packed_array_typecode(protobuf_type))
+    if len(value) % arr.itemsize != 0:
+        raise RuntimeError("invalid packed %s length %d" % (protobuf_type, len(value)))
+    try:
+        arr.frombytes(value) # Python 3
+    except AttributeError:
+        arr.fromstring(bytes(value)) # Python 2, pylint: disable=no-member
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+def decode_packed_varints(value):
+    buf = as_buffer(value)
+    values = []
+    append = values.append
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        bits = buf[pos]
+        pos += 1
+        if bits < 0x80:
+            append(bits)
+            continue
+        v = bits & 0x7f
+        bitshift = 7
+        while bits & 0x80:
+            if pos == end:
+                raise RuntimeError("unexpected end of packed varints")
+            bits = buf[pos]
+            pos += 1
+            v |= (bits & 0x7f) << bitshift
+            bitshift += 7
+        append(v)
+    return values
+
+def numpy_packed_decoder(protobuf_type):
+    if protobuf_type not in PACKED_STRUCT_FORMATS and protobuf_type not in PACKED_VARINT_FORMATS:
+        return None
+    from .packed_numpy import decode_packed
+    return lambda v: decode_packed(v, protobuf_type)
+
+# as_array: False for lists, True for array.array or 'numpy' for numpy arrays
+def packed_decoder(protobuf_type, as_array=False):
+    if as_array == 'numpy':
+        return numpy_packed_decoder(protobuf_type)
+    if protobuf_type in PACKED_STRUCT_FORMATS:
+        if as_array:
+            return lambda v: decode_packed_fixed_array(v, protobuf_type)
+        return lambda v: decode_packed_fixed(v, protobuf_type)
+    if protobuf_type not in PACKED_VARINT_FORMATS:
+        return None
+    if protobuf_type in ("int", "int32", "int64"):
+        decode_list = decode_packed_varints
+    else:
+        decode = DECODERS[protobuf_type]
+        decode_list = lambda v: [decode(x) for x in decode_packed_varints(v)]
+    if as_array:
+        typecode = packed_array_typecode(protobuf_type)
+        return lambda v: array.array(typecode, decode_list(v))
+    return decode_list
+
+# lists and array.arrays are extended in place, numpy arrays concatenated
+def extend_values(values, more):
+    try:
+        values.extend(more)
+        return values
+    except AttributeError:
+        from .packed_numpy import concatenate
+        return concatenate(values, more)
+
 def decode_field(value_bytes, protobuf_type):
     if protobuf_type not in DECODERS:
         raise RuntimeError("invalid type " + protobuf_type)
     return DECODERS[protobuf_type](value_bytes)
 
-def parse_stream_with_spec(in_stream, spec):
-    result = {}
-    def decode_msg(msg, field, wire_type, decoder):
-        if str(decoder) in DECODERS:
-            if WIRE_TYPES[decoder] != wire_type:
-                raise RuntimeError("invalid wire type %d for field %s" % (wire_type, field))
-            return decode_field(msg, decoder)
-        if isinstance(decoder, list):
-            # To Do: support packed repeated fields
-            return [decode_msg(msg, field, wire_type, decoder[0])]
+# decoder for a parse_spec-style spec, interpreted once: each field number
+# maps to a prebound decoder function and its expected wire type
+class CompiledSpec(object):
+    def __init__(self, spec, packed_arrays=False, stats=None, path=''):
+        if not isinstance(spec, dict):
+            raise RuntimeError("invalid spec (expected dict): " + str(spec))
+        self.packed_arrays = packed_arrays
+        self.stats = stats
+        self.path = path
+        self.fields = {}
+        for field, decoder in spec.items():
+            repeated = isinstance(decoder, list)
+            if repeated:
+                decoder = decoder[0]
+            wire_type, decode = self.compile_decoder(field, decoder)
+            new_values = decode_packed = None
+            if repeated:
+                new_values = list
+                if not isinstance(decoder, dict):
+                    decode_packed = packed_decoder(decoder, packed_arrays)
+                    if decode_packed is not None and packed_arrays is True:
+                        typecode = packed_array_typecode(decoder)
+                        new_values = lambda typecode=typecode: array.array(typecode)
+            self.fields[int(field)] = (str(field), wire_type, decode, new_values, decode_packed)
+        # fields not in the spec are skipped without reading their payloads,
+        # except when collecting stats of all fields
+        self.projection = self.fields if stats is None else None
+
+    def compile_decoder(self, field, decoder):
         if isinstance(decoder, dict):
-            return parse_bytes_with_spec(msg, decoder)
-        raise RuntimeError("invalid decoder spec " + str(decoder))
+            path = self.path + '.' + str(field) if self.path else str(field)
+            # nested specs of an InstrumentedSpec are instrumented too
+            nested = type(self)(decoder, self.packed_arrays, self.stats, path)
+            return LENGTH_DELIM, nested.decode_bytes
+        if str(decoder) in DECODERS:
+            return WIRE_TYPES[decoder], DECODERS[decoder]
+        raise RuntimeError("invalid decoder spec %s for field %s" % (str(decoder), field))
 
-    if not isinstance(spec, dict):
-        raise RuntimeError("invalid spec (expected dict): " + str(spec))
-
-    for msg, field, wire in parse_stream(in_stream):
-        field = str(field)
-        if field in spec:
-            decoded = decode_msg(msg, field, wire, spec[field])
-            if isinstance(decoded, list):
-                if field not in result: result[field] = []
-                result[field].extend(decoded)
+    def decode_messages(self, messages):
+        result = {}
+        fields = self.fields
+        for msg, field, wire_type in messages:
+            entry = fields.get(field)
+            if entry is None:
+                continue
+            key, expected_wire_type, decode, new_values, decode_packed = entry
+            if wire_type != expected_wire_type:
+                # packed repeated scalars: all values in one LENGTH_DELIM payload
+                if wire_type == LENGTH_DELIM and decode_packed is not None:
+                    values = result.get(key)
+                    if values is None:
+                        result[key] = decode_packed(msg)
+                    else:
+                        result[key] = extend_values(values, decode_packed(msg))
+                    continue
+                raise RuntimeError("invalid wire type %d for field %s" % (wire_type, key))
+            if new_values is not None:
+                decoded = decode(msg)
+                values = result.get(key)
+                if values is None:
+                    values = result[key] = new_values()
+                try:
+                    values.append(decoded)
+                except AttributeError:
+                    result[key] = extend_values(values, [decoded])
+            else:
+                result[key] = decode(msg)
+        return result
+
+    # decodes a single entry (a list for repeated fields), None if the field
+    # is not in the spec
+    def decode_entry(self, msg, field_number, wire_type):
+        entry = self.fields.get(field_number)
+        if entry is None:
+            return None
+        key, expected_wire_type, decode, new_values, decode_packed = entry
+        if wire_type != expected_wire_type:
+            if wire_type == LENGTH_DELIM and decode_packed is not None:
+                return decode_packed(msg)
+            raise RuntimeError("invalid wire type %d for field %s" % (wire_type, key))
+        if new_values is not None:
+            values = new_values()
+            values.append(decode(msg))
+            return values
+        return decode(msg)
+
+    def decode_stream(self, in_stream):
+        if self.projection is None:
+            return self.decode_messages(parse_stream(in_stream))
+        return self.decode_messages(parse_stream_projected(in_stream, self.projection))
+
+    def decode_bytes(self, data):
+        if self.projection is None:
+            return self.decode_messages(parse_buffer(data))
+        if not self.projection:
+            return {} # nothing requested from this submessage
+        return self.decode_messages(parse_buffer_projected(data, self.projection))
+
+# CompiledSpec that records the entries and the decoding time of each spec
+# subtree in a stats.DecodeStats, a subclass so that uninstrumented specs
+# decode without any per-field checks
+class InstrumentedSpec(CompiledSpec):
+    def decode_messages(self, messages):
+        decode_messages = super(InstrumentedSpec, self).decode_messages
+        return self.stats.decode_messages(decode_messages, messages, self.path)
+
+def compile_spec(spec, packed_arrays=False, stats=None):
+    if isinstance(spec, CompiledSpec):
+        return spec
+    if stats is not None:
+        return InstrumentedSpec(spec, packed_arrays, stats)
+    return CompiledSpec(spec, packed_arrays)
+
+# Push parser for wire data arriving in arbitrary fragments: feed(data)
+# returns a list of the (field_number, wire_type, value) events of all
+# fields completed so far. Values are ints for varints and otherwise bytes.
+# With a spec, only the fields in it are returned, decoded in place
+# (including nested messages).
+class WireParser(object):
+    def __init__(self, spec=None):
+        self.parser = StreamParser(parse_entry_bounds, "protobuf field")
+        self.decoder = None if spec is None else compile_spec(spec)
+
+    # the events are collected before returning because the payload views
+    # are only valid until the next feed
+    def feed(self, data):
+        parser = self.parser
+        parser.feed(data)
+        decoder = self.decoder
+        events = []
+        for msg, (field_number, wire_type) in parser.messages():
+            if wire_type == VARINT:
+                value = read_varint_from_buffer(as_buffer(msg), 0)[0]
+                if decoder is not None:
+                    value = decoder.decode_entry(value, field_number, wire_type)
+            elif decoder is not None:
+                value = decoder.decode_entry(as_buffer(msg), field_number, wire_type)
             else:
-                result[field] = decoded
+                value = msg.tobytes()
+            if value is not None:
+                events.append((field_number, wire_type, value))
+        return events
 
-    return result
+    # call at the end of the data, fails on incomplete fields
+    def close(self):
+        self.parser.close()
+
+# stats: optional stats.DecodeStats (ignored for already compiled specs)
+def parse_messages_with_spec(messages, spec, stats=None):
+    return compile_spec(spec, stats=stats).decode_messages(messages)
+
+def parse_stream_with_spec(in_stream, spec, stats=None):
+    return compile_spec(spec, stats=stats).decode_stream(in_stream)
 
 def parse_bytes_with_spec(string, spec):
     if str(spec) in DECODERS:
         return decode_field(string, spec)
-    in_stream = BytesIO(string)
-    return parse_stream_with_spec(in_stream, spec)
+    return compile_spec(spec).decode_bytes(string)
+
+@contextmanager
+def mapped_file(path):
+    import mmap, os
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        # all payloads, including nested messages, are views into the mapping
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                pass # views still referenced by a traceback, unmapped when collected
+
+def parse_file_with_spec(path, spec):
+    with mapped_file(path) as buf:
+        return parse_bytes_with_spec(buf, spec)
+
+# e.g., 2:string,3:{2:float,4:[1:sfixed32]},5:[int], where [...] is a
+# repeated field of a type or of messages, which may also be written as
+# [{...}]. Parsed in a single pass over the tokens (numbers and type names,
+# punctuation), whitespace is ignored
+SPEC_TOKENS = re.compile(r'\s*(?:([A-Za-z0-9_]+)|(.))')
+
+def tokenize_spec(spec):
+    tokens = []
+    for match in SPEC_TOKENS.finditer(spec):
+        word, punctuation = match.groups()
+        if word is not None:
+            tokens.append(word)
+        elif punctuation is not None:
+            if punctuation not in ':,[]{}':
+                raise RuntimeError("invalid character %s in spec %s" % (punctuation, spec))
+            tokens.append(punctuation)
+    return tokens
+
+class SpecParser(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.tokens = tokenize_spec(spec)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise RuntimeError("invalid syntax: unexpected end of %s" % self.spec)
+        self.pos += 1
+        return token
+
+    def expect(self, expected):
+        token = self.take()
+        if token != expected:
+            raise RuntimeError("invalid syntax: expected %s instead of %s in %s" % (expected, token, self.spec))
+
+    def parse(self):
+        if len(self.tokens) == 1 and self.tokens[0] in DECODERS:
+            return self.tokens[0]
+        result = self.message()
+        if self.peek() is not None:
+            raise RuntimeError("invalid syntax: unexpected %s in %s" % (self.peek(), self.spec))
+        return result
+
+    # fields, optionally in { }
+    def message(self):
+        if self.peek() == '{':
+            self.take()
+            result = self.fields()
+            self.expect('}')
+            return result
+        return self.fields()
+
+    def fields(self):
+        result = {}
+        while True:
+            tag = self.take()
+            if not tag.isdigit():
+                raise RuntimeError("invalid field number %s in %s" % (tag, self.spec))
+            tag = str(int(tag))
+            self.expect(':')
+            result[tag] = self.value()
+            if self.peek() != ',':
+                return result
+            self.take()
+            if self.peek() in (None, '}', ']'):
+                return result # a trailing comma
+
+    def value(self):
+        token = self.peek()
+        if token == '{':
+            return self.message()
+        if token == '[':
+            self.take()
+            if self.peek() in DECODERS:
+                element = self.take()
+            else:
+                element = self.message()
+            self.expect(']')
+            return [element]
+        token = self.take()
+        if token not in DECODERS:
+            raise RuntimeError('invalid decoder ' + token)
+        return token
+
+def copy_spec(spec):
+    if isinstance(spec, dict):
+        return dict((field, copy_spec(decoder)) for field, decoder in spec.items())
+    if isinstance(spec, list):
+        return [copy_spec(spec[0])]
+    return spec
+
+# the structure of a parsed spec, without compiling it
+def check_spec(spec):
+    if isinstance(spec, list) and len(spec) == 1:
+        spec = spec[0]
+    if isinstance(spec, dict):
+        for field, decoder in spec.items():
+            if not str(field).isdigit():
+                raise RuntimeError("invalid field number %s in spec" % field)
+            check_spec(decoder)
+    elif str(spec) not in DECODERS:
+        raise RuntimeError("invalid decoder spec %s" % str(spec))
+
+# least recently used parsed specs by spec string
+SPEC_CACHE_SIZE = 128
+SPEC_CACHE = OrderedDict()
 
 def parse_spec(spec):
-    # to allow both { 2: [{ 1:float }] } and { 2: [1:float] }
-    if spec[0] == '{':
-        return parse_spec(spec[:-1])
-
-    def split_on_closing(s, begin, end):
-        # note: no escaping is like "im a { string" is possible here
-        count = 0
-        for i in range(len(s)):
-            if s[i] == begin: count += 1
-            elif s[i] == end:
-                count -= 1
-                if count == 0:
-                    return s[1:i], s[i+1:]
-        raise RuntimeError("invalid syntax: expected %s before the end of %s" % (end, s))
-
-    if spec in DECODERS: return spec
-
-    tag, _, rest = spec.partition(':')
-    tag = str(int(tag))
-    result = {}
-    if rest[0] == '[':
-        sub, rest = split_on_closing(rest, '[', ']')
-        result[tag] = [parse_spec(sub)]
-
-    elif rest[0] == '{':
-        sub, rest = split_on_closing(rest, '{', '}')
-        result[tag] = parse_spec(sub)
-    else:
-        parts = rest.split(',')
-        sub = parts[0]
-        if sub not in DECODERS:
-            raise RuntimeError('invalid decoder ' + sub)
-        result[tag] = sub
-        rest = ','.join(parts[1:])
-        if len(rest) > 0: rest = ',' + rest
-    if len(rest) > 0:
-        if rest[0] != ',':
-            raise RuntimeError("syntax error: expected ',' to begin %s" % rest)
-        rest = rest[1:]
-
-        for field, decoder in parse_spec(rest).items():
-            result[field] = decoder
-
-    return result
+    try:
+        parsed = SPEC_CACHE.pop(spec)
+    except KeyError:
+        parsed = SpecParser(spec).parse()
+        if len(SPEC_CACHE) >= SPEC_CACHE_SIZE:
+            SPEC_CACHE.popitem(last=False)
+    SPEC_CACHE[spec] = parsed
+    # callers may modify the returned spec
+    return copy_spec(parsed)
+
+# Parsed specs can be saved as JSON, which is faster to load than parsing
+# a long spec string in every process
+SPEC_FILE_FORMAT = 'protowire-spec-1'
+
+def save_spec(spec, path):
+    import json
+    if not isinstance(spec, dict):
+        spec = parse_spec(spec)
+    data = json.dumps({'format': SPEC_FILE_FORMAT, 'spec': spec}, sort_keys=True, separators=(',', ':'))
+    with open(path, 'wb') as f:
+        f.write(data.encode('utf-8'))
+
+def load_spec(path):
+    import json
+    with open(path, 'rb') as f:
+        try:
+            data = json.loads(f.read().decode('utf-8'))
+        except ValueError:
+            data = None
+    if not isinstance(data, dict) or data.get('format') != SPEC_FILE_FORMAT:
+        raise RuntimeError("not a protowire spec file: " + path)
+    spec = data.get('spec')
+    check_spec(spec)
+    return spec
 
 # simple stream generator, assumes LENGTH_DELIM wire_tyep, ignores fields
 def protobuf_stream_gen(in_stream):
     for entry in parse_stream(in_stream):
         yield entry[0]
+
+# decode each element of a length-delimited collection separately, so that
+# only one element at a time needs to be in memory
+def parse_collection_with_spec(in_stream, spec):
+    decoder = compile_spec(spec)
+    for msg in protobuf_stream_gen(in_stream):
+        yield decoder.decode_bytes(msg)
+
+def parse_file_collection_with_spec(path, spec):
+    decoder = compile_spec(spec)
+    with mapped_file(path) as buf:
+        for msg, _, _ in parse_buffer(buf):
+            yield decoder.decode_bytes(msg)
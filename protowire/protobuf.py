@@ -6,29 +6,36 @@ from .wire_type import VARINT, FIXED64, LENGTH_DELIM, FIXED32
 # to disalbe incorrect inconsistent-return-statements in encode_float
 # pylint: disable=R
 
+try:
+    STRING_TYPE = unicode # Python 2
+except NameError:
+    STRING_TYPE = str # Python 3
+
 def is_string_like(s):
-    try:
-        return isinstance(s, unicode) # Python 2
-    except NameError:
-        return isinstance(s, str) # Python 3
+    return isinstance(s, STRING_TYPE)
+
+# does not import numpy, which is an optional dependency
+def is_numpy_array(value):
+    return type(value).__name__ == 'ndarray' and type(value).__module__ == 'numpy'
 
 def int2bytes(u):
     if not isinstance(u, list):
         u = [u]
     return bytes(bytearray(u))
 
+SMALL_VARINTS = [int2bytes(v) for v in range(0x80)]
+
 def encode_varint(value):
+    if 0 <= value < 0x80:
+        return SMALL_VARINTS[value]
     if value < 0:
         value += (1 << 64)
-    bits = value & 0x7f
-    value >>= 7
-    bytearr = []
-    while value:
-        bytearr.append(0x80|bits)
-        bits = value & 0x7f
+    bytearr = bytearray()
+    while value > 0x7f:
+        bytearr.append(0x80 | (value & 0x7f))
         value >>= 7
-    bytearr.append(bits)
-    return int2bytes(bytearr)
+    bytearr.append(value)
+    return bytes(bytearr)
 
 def encode_zigzag(value, bits):
     return (value << 1) ^ (value >> (bits-1))
@@ -81,27 +88,34 @@ def define_encoders():
             default_value=lambda s: bool_string_to_int(s)==0)
     }
 
-    int_encoders = {
-        "int": Encoder(VARINT, encode_varint),
-        "int32": Encoder(VARINT, encode_varint),
-        "int64": Encoder(VARINT, encode_varint),
-        "sint32": Encoder(VARINT, lambda v: encode_varint(encode_zigzag(v, 32))),
-        "sint64": Encoder(VARINT, lambda v: encode_varint(encode_zigzag(v, 64))),
-        "fixed32": Encoder(FIXED32, lambda v: encode_int_little_endian(v, 32, signed=False)),
-        "fixed64": Encoder(FIXED64, lambda v: encode_int_little_endian(v, 64, signed=False)),
-        "sfixed32": Encoder(FIXED32, lambda v: encode_int_little_endian(v, 32, signed=True)),
-        "sfixed64": Encoder(FIXED64, lambda v: encode_int_little_endian(v, 64, signed=True)),
-    }
-
-    for t, e in int_encoders.items():
-        encoders[t] = Encoder(e.wire_type, lambda v, e=e: e.encode(int(v)))
+    # int() conversion inlined to keep the per-value call depth low
+    encoders.update({
+        "int": Encoder(VARINT, lambda v: encode_varint(int(v))),
+        "int32": Encoder(VARINT, lambda v: encode_varint(int(v))),
+        "int64": Encoder(VARINT, lambda v: encode_varint(int(v))),
+        "sint32": Encoder(VARINT, lambda v: encode_varint(encode_zigzag(int(v), 32))),
+        "sint64": Encoder(VARINT, lambda v: encode_varint(encode_zigzag(int(v), 64))),
+        "fixed32": Encoder(FIXED32, lambda v: encode_int_little_endian(int(v), 32, signed=False)),
+        "fixed64": Encoder(FIXED64, lambda v: encode_int_little_endian(int(v), 64, signed=False)),
+        "sfixed32": Encoder(FIXED32, lambda v: encode_int_little_endian(int(v), 32, signed=True)),
+        "sfixed64": Encoder(FIXED64, lambda v: encode_int_little_endian(int(v), 64, signed=True)),
+    })
 
     return encoders
 
 ENCODERS = define_encoders()
 
+# encoded tags by (field_number << 3) | wire_type
+KEY_CACHE = {}
+
 def encode_key(field_number, wire_type):
-    return encode_varint((field_number << 3) | wire_type)
+    tag = (field_number << 3) | wire_type
+    try:
+        return KEY_CACHE[tag]
+    except KeyError:
+        key = encode_varint(tag)
+        KEY_CACHE[tag] = key
+        return key
 
 def encode_message(field_number, proto_type, value):
 
@@ -111,16 +125,109 @@ def encode_message(field_number, proto_type, value):
         if len(value) == 0:
             return b''
 
-        wire_type = LENGTH_DELIM
-        payload = []
-        for v in value:
-            payload.append(encoder.encode(v))
-        payload = b''.join(payload)
-        payload = encode_varint(len(payload)) + payload
-    else:
-        if encoder.default_value(value):
+        encode = encoder.encode
+        payload = b''.join([encode(v) for v in value])
+        return b''.join([encode_key(field_number, LENGTH_DELIM), encode_varint(len(payload)), payload])
+
+    if is_numpy_array(value):
+        if len(value) == 0:
             return b''
-        wire_type = encoder.wire_type
-        payload = encoder.encode(value)
 
-    return encode_key(field_number, wire_type) + payload
+        from .packed_numpy import encode_packed
+        payload = encode_packed(proto_type, value)
+        return b''.join([encode_key(field_number, LENGTH_DELIM), encode_varint(len(payload)), payload])
+
+    if encoder.default_value(value):
+        return b''
+    return encode_key(field_number, encoder.wire_type) + encoder.encode(value)
+
+# builds a message (or a collection of messages) into a single bytearray,
+# nested messages are written in place and their length prefix filled in
+# when they are closed
+# (a plain class instead of contextlib.contextmanager, which is slow to
+# import on the pw startup path)
+class NestedMessage(object):
+    def __init__(self, writer, field_number):
+        self.writer = writer
+        self.field_number = field_number
+
+    def __enter__(self):
+        self.writer.begin_message(self.field_number)
+        return self.writer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.writer.end_message()
+
+# Lengths of 128 bytes or more do not fit the one byte reserved for them.
+# Small payloads are moved right away, larger ones are collected as (slot
+# position, encoded length) and the buffer is compacted once when the
+# outermost message is closed, instead of moving the payload at every
+# nesting level. extra is the number of bytes these lengths add to the
+# buffer, needed for the lengths of enclosing messages
+MOVE_IN_PLACE_SIZE = 16 * 1024
+
+class MessageWriter(object):
+    def __init__(self):
+        self.buffer = bytearray()
+        # (payload start, extra at begin_message)
+        self.open_messages = []
+        self.long_lengths = []
+        self.extra = 0
+
+    def write(self, field_number, proto_type, value):
+        self.buffer += encode_message(field_number, proto_type, value)
+
+    def write_raw(self, data):
+        self.buffer += data
+
+    def begin_message(self, field_number):
+        self.buffer += encode_key(field_number, LENGTH_DELIM)
+        # reserve one byte for the length, enough for messages below 128 bytes
+        self.buffer.append(0)
+        self.open_messages.append((len(self.buffer), self.extra))
+
+    def end_message(self):
+        start, extra = self.open_messages.pop()
+        length = len(self.buffer) - start + self.extra - extra
+        if length < 0x80:
+            self.buffer[start - 1] = length
+        elif length < MOVE_IN_PLACE_SIZE and not self.long_lengths:
+            self.buffer[start - 1:start] = encode_varint(length)
+        else:
+            encoded = encode_varint(length)
+            self.long_lengths.append((start - 1, encoded))
+            self.extra += len(encoded) - 1
+        if not self.open_messages and self.long_lengths:
+            self.compact()
+
+    # writes the long lengths in place of their slots, moving the data after
+    # the first slot once
+    def compact(self):
+        buf = self.buffer
+        if len(self.long_lengths) == 1:
+            slot, encoded = self.long_lengths[0]
+            buf[slot:slot + 1] = encoded
+            self.long_lengths = []
+            self.extra = 0
+            return
+        slots = sorted(self.long_lengths)
+        first = pos = slots[0][0]
+        compacted = bytearray()
+        for slot, encoded in slots:
+            compacted += buf[pos:slot]
+            compacted += encoded
+            pos = slot + 1
+        compacted += buf[pos:]
+        buf[first:] = compacted
+        self.long_lengths = []
+        self.extra = 0
+
+    # with writer.message(field_number): ...
+    def message(self, field_number):
+        return NestedMessage(self, field_number)
+
+    def getvalue(self):
+        if self.open_messages:
+            raise RuntimeError("%d nested messages not closed" % len(self.open_messages))
+        return bytes(self.buffer)
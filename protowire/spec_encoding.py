@@ -0,0 +1,258 @@
+# Encoding dicts, e.g., parsed JSON objects like the pw-decode output, to
+# wire messages with a parse_spec spec: {"1": 150, "3": {"2": "x"}} with
+# 1:int,3:{2:string}. Fields are written in field number order, repeated
+# numeric fields are packed and nested messages are written in place into a
+# single MessageWriter buffer. Like pw, scalar default values (0, "",
+# false) are not written, but empty nested messages and repeated elements
+# are. Keys not in the spec and values of the wrong type are errors.
+import binascii
+import numbers
+
+from .protobuf import ENCODERS, STRING_TYPE, MessageWriter, encode_key, encode_message, encode_string
+from .grpc_frame import GRPC_FRAME_HEADER
+from .wire_type import LENGTH_DELIM
+
+# str and unicode in Python 2
+TEXT_TYPES = (STRING_TYPE, str)
+
+try:
+    INT_TYPES = (int, long) # Python 2
+except NameError:
+    INT_TYPES = (int,)
+
+# JSON values to the values expected by ENCODERS, None for values of the
+# wrong type. Integral floats are accepted for ints
+def int_value(v):
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, numbers.Integral):
+        return v
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return None
+
+def float_value(v):
+    if isinstance(v, numbers.Real) and not isinstance(v, bool):
+        return v
+    return None
+
+def bool_value(v):
+    if isinstance(v, (bool, int)):
+        return 'true' if v else 'false'
+    if isinstance(v, TEXT_TYPES) and v.lower() in ('true', 'false'):
+        return v
+    return None
+
+# ints in the range of a fixed-size type, which cannot be packed otherwise
+def fixed_value(bits, signed):
+    low, high = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1) if signed else (0, (1 << bits) - 1)
+    def to_value(v):
+        v = int_value(v)
+        if v is None or not low <= v <= high:
+            return None
+        return v
+    return to_value
+
+def string_value(v):
+    if isinstance(v, (STRING_TYPE, bytes)):
+        return v
+    return None
+
+def hex_value(v):
+    if not isinstance(v, TEXT_TYPES):
+        return None
+    try:
+        return binascii.unhexlify(v)
+    except (TypeError, ValueError, binascii.Error):
+        return None # odd length or not hex digits
+
+# exact types (not subclasses like bool) of values that are valid as they are
+VALID_TYPES = {
+    'float': (float,) + INT_TYPES,
+    'double': (float,) + INT_TYPES,
+    'string': (STRING_TYPE, bytes),
+    'bytes': (STRING_TYPE, bytes),
+    'bool': (),
+    'hex': (),
+    'fixed32': (),
+    'fixed64': (),
+    'sfixed32': (),
+    'sfixed64': ()
+}
+
+VALUE_CONVERSIONS = {
+    'bool': bool_value,
+    'float': float_value,
+    'double': float_value,
+    'string': string_value,
+    'bytes': string_value,
+    'hex': hex_value,
+    'fixed32': fixed_value(32, False),
+    'fixed64': fixed_value(64, False),
+    'sfixed32': fixed_value(32, True),
+    'sfixed64': fixed_value(64, True)
+}
+
+def value_converter(field_number, proto_type):
+    to_value = VALUE_CONVERSIONS.get(proto_type, int_value)
+    def convert(value):
+        converted = to_value(value)
+        if converted is None:
+            raise RuntimeError("invalid %s value in field %d: %r" % (proto_type, field_number, value))
+        return converted
+    return convert
+
+# values of valid_types are written without the conversion call
+def scalar_writer(field_number, proto_type, repeated):
+    encoder_type = 'bytes' if proto_type == 'hex' else proto_type
+    if encoder_type not in ENCODERS:
+        raise RuntimeError("invalid type " + proto_type)
+    convert = value_converter(field_number, proto_type)
+    valid_types = frozenset(VALID_TYPES.get(proto_type, INT_TYPES))
+    if not repeated:
+        def write(writer, value):
+            if type(value) not in valid_types:
+                if isinstance(value, (list, dict)):
+                    raise RuntimeError("expected a single %s in field %d" % (proto_type, field_number))
+                value = convert(value)
+            writer.buffer += encode_message(field_number, encoder_type, value)
+        return write
+    if ENCODERS[encoder_type].wire_type == LENGTH_DELIM:
+        # strings are not packed, empty elements are kept
+        key = encode_key(field_number, LENGTH_DELIM)
+        def write_each(writer, values):
+            buf = writer.buffer
+            for value in values:
+                if type(value) not in valid_types:
+                    value = convert(value)
+                buf += key
+                buf += encode_string(value)
+        return write_each
+    def write_packed(writer, values):
+        if not valid_types.issuperset(map(type, values)):
+            values = [convert(v) for v in values]
+        writer.buffer += encode_message(field_number, encoder_type, values)
+    return write_packed
+
+def message_writer(field_number, encoder, repeated):
+    def write(writer, value):
+        with writer.message(field_number):
+            encoder.write(writer, value)
+    if not repeated:
+        return write
+    def write_each(writer, values):
+        for value in values:
+            write(writer, value)
+    return write_each
+
+class SpecEncoder(object):
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise RuntimeError("invalid spec (expected dict): " + str(spec))
+        # (key, write(writer, value), repeated) in field number order
+        self.fields = []
+        for field, encoder in sorted(spec.items(), key=lambda f: int(f[0])):
+            repeated = isinstance(encoder, list)
+            if repeated:
+                encoder = encoder[0]
+            field_number = int(field)
+            if isinstance(encoder, dict):
+                write = message_writer(field_number, SpecEncoder(encoder), repeated)
+            else:
+                write = scalar_writer(field_number, str(encoder), repeated)
+            self.fields.append((str(field), write, repeated))
+        self.keys = frozenset(key for key, _, _ in self.fields)
+
+    # appends the fields of obj to a MessageWriter
+    def write(self, writer, obj):
+        if not isinstance(obj, dict):
+            raise RuntimeError("expected an object, got " + str(obj))
+        n_written = 0
+        for key, write, repeated in self.fields:
+            value = obj.get(key)
+            if value is None:
+                continue
+            n_written += 1
+            if repeated and not isinstance(value, list):
+                value = [value]
+            write(writer, value)
+        if n_written < len(obj):
+            unknown = [key for key in obj if key not in self.keys and obj[key] is not None]
+            if unknown:
+                raise RuntimeError("fields not in the spec: " + ', '.join(sorted(unknown)))
+
+    def encode(self, obj):
+        writer = MessageWriter()
+        self.write(writer, obj)
+        return writer.getvalue()
+
+def compile_encoder(spec):
+    if isinstance(spec, SpecEncoder):
+        return spec
+    return SpecEncoder(spec)
+
+def encode_with_spec(obj, spec):
+    return compile_encoder(spec).encode(obj)
+
+def load_json(text, where):
+    import json
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        error = e
+    raise RuntimeError("invalid JSON %s: %s" % (where, error))
+
+# JSON objects of an input stream with one object per line (NDJSON), or a
+# single JSON array of objects, which is read as a whole
+def read_json_records(in_stream):
+    line_number = 0
+    first = True
+    # readline instead of iteration, which reads ahead in Python 2
+    for line in iter(in_stream.readline, ''):
+        line_number += 1
+        line = line.strip()
+        if not line:
+            continue
+        if first and line.startswith('['):
+            records = load_json(line + in_stream.read(), 'array')
+            if not isinstance(records, list):
+                raise RuntimeError("expected a JSON array or one object per line")
+            for record in records:
+                yield record
+            return
+        first = False
+        yield load_json(line, 'on line %d' % line_number)
+
+FLUSH_SIZE = 64 * 1024
+
+# Encodes the records (dicts) to out_stream as a length-delimited collection
+# with the given tag, or as GRPC frames (uncompressed). The output buffer is
+# reused and written out every flush_size bytes, so memory use does not grow
+# with the number of records. With flush_size=0, each record is written and
+# flushed as soon as it is encoded, e.g., for a pipe to a consumer of the
+# records. Returns the number of records
+def encode_records(records, out_stream, spec, grpc=False, tag=1, flush_size=FLUSH_SIZE):
+    # pylint: disable=R0913,R0917
+    encoder = compile_encoder(spec)
+    writer = MessageWriter()
+    buf = writer.buffer
+    n_records = 0
+    for record in records:
+        if grpc:
+            start = len(buf)
+            buf += b'\0\0\0\0\0' # header filled in when the length is known
+            encoder.write(writer, record)
+            GRPC_FRAME_HEADER.pack_into(buf, start, 0, len(buf) - start - GRPC_FRAME_HEADER.size)
+        else:
+            with writer.message(tag):
+                encoder.write(writer, record)
+        n_records += 1
+        if len(buf) >= flush_size:
+            out_stream.write(buf)
+            del buf[:]
+            if not flush_size:
+                out_stream.flush()
+    if buf:
+        out_stream.write(buf)
+        del buf[:]
+    return n_records
@@ -0,0 +1,115 @@
+# Optional instrumentation of spec decoding and GRPC framing. A DecodeStats
+# object passed to compile_spec(..., stats=...) or the GRPC stream
+# functions collects counters while decoding. Without it, the uninstrumented
+# code paths are used as is (no per-field checks).
+import heapq
+import time
+
+from .wire_type import VARINT
+
+# perf_counter is Python 3 only
+timer = getattr(time, 'perf_counter', time.time)
+
+def varint_size(value):
+    return max(1, (value.bit_length() + 6) // 7)
+
+def payload_size(msg, wire_type):
+    if wire_type == VARINT:
+        return varint_size(msg)
+    return len(msg)
+
+# field path of a nested spec entry, e.g., '3.2' for field 2 in field 3
+def child_path(path, key):
+    if path:
+        return path + '.' + key
+    return key
+
+class DecodeStats(object):
+    def __init__(self, n_largest=10):
+        # (field path, wire type) -> [count, payload bytes]
+        self.fields = {}
+        # spec subtree path -> [messages, seconds], '' is the root. The time
+        # of a subtree includes the time spent in its nested subtrees
+        self.subtrees = {}
+        self.n_largest = n_largest
+        # min-heap of (size, field path)
+        self.largest = []
+        # GRPC frames: [count, payload bytes, compressed]
+        self.frames = [0, 0, 0]
+        # log2 bucket -> count
+        self.frame_size_buckets = {}
+
+    def record_field(self, path, wire_type, size):
+        counters = self.fields.get((path, wire_type))
+        if counters is None:
+            counters = self.fields[(path, wire_type)] = [0, 0]
+        counters[0] += 1
+        counters[1] += size
+        if len(self.largest) < self.n_largest:
+            heapq.heappush(self.largest, (size, path))
+        elif size > self.largest[0][0]:
+            heapq.heapreplace(self.largest, (size, path))
+
+    def record_subtree(self, path, seconds):
+        counters = self.subtrees.get(path)
+        if counters is None:
+            counters = self.subtrees[path] = [0, 0.0]
+        counters[0] += 1
+        counters[1] += seconds
+
+    def record_frame(self, size, compressed=False):
+        counters = self.frames
+        counters[0] += 1
+        counters[1] += size
+        if compressed:
+            counters[2] += 1
+        bucket = size.bit_length()
+        self.frame_size_buckets[bucket] = self.frame_size_buckets.get(bucket, 0) + 1
+
+    # called by InstrumentedSpec.decode_messages with the uninstrumented
+    # CompiledSpec.decode_messages of the spec subtree at path
+    def decode_messages(self, decode_messages, messages, path):
+        start = timer()
+        result = decode_messages(self.count_entries(messages, path))
+        self.record_subtree(path, timer() - start)
+        return result
+
+    def count_entries(self, messages, path):
+        for entry in messages:
+            msg, field_number, wire_type = entry
+            self.record_field(child_path(path, str(field_number)), wire_type, payload_size(msg, wire_type))
+            yield entry
+
+    # (payload, info) iterators of the GRPC stream functions
+    def count_frames(self, frames):
+        for entry in frames:
+            self.record_frame(len(entry[0]))
+            yield entry
+
+    def count_grpc_frames(self, frames):
+        for entry in frames:
+            self.record_frame(len(entry[0]), bool(entry[1]))
+            yield entry
+
+    def as_dict(self):
+        fields = [{'path': path, 'wire_type': wire_type, 'count': count, 'bytes': size}
+            for (path, wire_type), (count, size) in self.fields.items()]
+        fields.sort(key=lambda f: (-f['bytes'], f['path']))
+        result = {
+            'fields': fields,
+            'subtrees': dict((path, {'messages': n, 'seconds': seconds})
+                for path, (n, seconds) in self.subtrees.items()),
+            'largest_payloads': [{'path': path, 'bytes': size}
+                for size, path in sorted(self.largest, reverse=True)]
+        }
+        count, size, compressed = self.frames
+        if count:
+            result['frames'] = {
+                'count': count,
+                'bytes': size,
+                'compressed': compressed,
+                # [min size, max size, count]
+                'size_distribution': [[(1 << b) >> 1, (1 << b) - 1, self.frame_size_buckets[b]]
+                    for b in sorted(self.frame_size_buckets)]
+            }
+        return result
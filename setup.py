@@ -42,7 +42,10 @@ setup(
             'pw=protowire.commandline:pw',
             'pw-grpc-frame=protowire.commandline:grpc_frame',
             'pw-grpc-client=protowire.commandline:grpc_client',
-            'pw-decode=protowire.commandline:pw_decode'
+            'pw-grpc-bench=protowire.commandline:grpc_bench',
+            'pw-decode=protowire.commandline:pw_decode',
+            'pw-filter=protowire.commandline:pw_filter',
+            'pw-encode=protowire.commandline:pw_encode'
         ],
     },
 
@@ -53,5 +56,6 @@ setup(
     extras_require={
         'dev': ['nose', 'pylint', 'check-manifest'],
         'grpc': ['grcpio'],
+        'numpy': ['numpy'],
     }
 )
@@ -3,16 +3,55 @@
 import unittest
 
 import protowire.wire_type
-from protowire.proto_decoding import parse_bytes, decode_field, decode_zigzag, parse_bytes_with_spec, parse_spec
-from protowire.protobuf import encode_message, encode_varint, encode_zigzag
+from protowire.proto_decoding import parse_bytes, decode_field, decode_zigzag, parse_bytes_with_spec, parse_spec, \
+    parse_buffer, parse_stream, parse_file_with_spec, compile_spec, parse_collection_with_spec, \
+    parse_stream_with_spec, WireParser
+from protowire.protobuf import encode_message, encode_varint, encode_zigzag, MessageWriter
 from protowire.grpc_frame import encode_grpc_frame, \
-    encode_uint32_big_endian, decode_int_big_endian
+    encode_uint32_big_endian, decode_int_big_endian, wrap_grpc_stream, unwrap_grpc_stream, \
+    read_grpc_frame, FrameCompressor
+
+# in-process GRPC server with Reverse (unary-unary), Join (stream-unary),
+# Repeat (unary-stream) and Echo (stream-stream) methods, skips the test if
+# grpcio is not installed. Returns (server, base url)
+def start_test_grpc_server(test):
+    try:
+        import grpc
+    except ImportError:
+        test.skipTest('grpcio not installed')
+    from concurrent.futures import ThreadPoolExecutor
+
+    def reverse(request, context):
+        if request == b'error':
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'error')
+        return request[::-1]
+    def join(requests, context):
+        return b'+'.join(requests)
+    def repeat(request, context):
+        return iter([request] * 2)
+    def echo(requests, context):
+        return iter(list(requests))
+    handlers = {
+        'Reverse': grpc.unary_unary_rpc_method_handler(reverse),
+        'Join': grpc.stream_unary_rpc_method_handler(join),
+        'Repeat': grpc.unary_stream_rpc_method_handler(repeat),
+        'Echo': grpc.stream_stream_rpc_method_handler(echo)
+    }
+    server = grpc.server(ThreadPoolExecutor(max_workers=4))
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler('test.Test', handlers),))
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+    return server, 'localhost:%d/test.Test/' % port
 
 class TestUnits(unittest.TestCase):
 
     def test_encode_varint(self):
         self.assertEqual(encode_varint(8), b'\x08')
         self.assertEqual(encode_varint(150), b'\x96\x01')
+        self.assertEqual(encode_varint(0), b'\x00')
+        self.assertEqual(encode_varint(127), b'\x7f')
+        self.assertEqual(encode_varint(128), b'\x80\x01')
+        self.assertEqual(encode_varint(-1), b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\x01')
 
     def test_encode_message_varints(self):
         self.assertEqual(encode_message(1, "int32", 0), b'')
@@ -51,6 +90,44 @@ class TestUnits(unittest.TestCase):
         self.assertEqual(encode_message(14, "int32", [0, 0]), b'\x72\x02\x00\x00')
         self.assertEqual(encode_message(14, "bool", ["false", "true"]), b'\x72\x02\x00\x01')
 
+    def test_message_writer(self):
+        writer = MessageWriter()
+        writer.write(1, 'string', 'hello')
+        with writer.message(3):
+            writer.write(1, 'int', 150)
+            with writer.message(2):
+                writer.write(1, 'string', 'a'*200)
+            writer.write(4, 'sint32', [1, -1])
+        writer.begin_message(5)
+        writer.end_message()
+        writer.write_raw(b'\x08\x01')
+
+        inner = encode_message(1, 'string', 'a'*200)
+        outer = encode_message(1, 'int', 150) + encode_message(2, 'bytes', inner) + \
+            encode_message(4, 'sint32', [1, -1])
+        self.assertEqual(writer.getvalue(), encode_message(1, 'string', 'hello') + \
+            encode_message(3, 'bytes', outer) + b'\x2a\x00\x08\x01')
+
+        # long messages at several depths, including lengths that only fit
+        # once the lengths of the nested messages are known
+        for size in (1, 100, 125, 200, 20000):
+            writer = MessageWriter()
+            expected = encode_message(1, 'string', 'x' * size)
+            with writer.message(2):
+                with writer.message(3):
+                    with writer.message(4):
+                        writer.write(1, 'string', 'x' * size)
+                    writer.write(5, 'int', 1)
+                with writer.message(6):
+                    writer.write(1, 'string', 'y' * 200)
+            expected = encode_message(2, 'bytes', encode_message(3, 'bytes', encode_message(4, 'bytes', expected) +
+                encode_message(5, 'int', 1)) + encode_message(6, 'bytes', encode_message(1, 'string', 'y' * 200)))
+            self.assertEqual(writer.getvalue(), expected)
+
+        writer.begin_message(1)
+        with self.assertRaises(RuntimeError):
+            writer.getvalue()
+
     def test_encode_message_bool(self):
         self.assertEqual(encode_message(12, "bool", "true"), b'\x60\x01')
         self.assertEqual(encode_message(12, "bool", "True"), b'\x60\x01')
@@ -87,6 +164,201 @@ class TestUnits(unittest.TestCase):
     def test_encode_grpc_frame(self):
         self.assertEqual(encode_grpc_frame(b'\xde\xad\xbe\xef'), b'\x00\x00\x00\x00\x04\xde\xad\xbe\xef')
 
+    def test_grpc_streams(self):
+        from io import BytesIO
+
+        class FragmentedStream(BytesIO):
+            def read1(self, n=-1):
+                return self.read(min(n, 3))
+
+        messages = [b'x' * (i * 37 % 300 + 1) for i in range(100)] + [b'y' * 100000]
+        collection = b''.join(encode_message(1, 'bytes', m) for m in messages)
+        frames = b''.join(encode_grpc_frame(m) for m in messages)
+
+        for stream_class in (BytesIO, FragmentedStream):
+            out = BytesIO()
+            wrap_grpc_stream(stream_class(collection), out)
+            self.assertEqual(out.getvalue(), frames)
+
+            out = BytesIO()
+            unwrap_grpc_stream(stream_class(frames), out)
+            self.assertEqual(out.getvalue(), collection)
+
+        out = BytesIO()
+        unwrap_grpc_stream(BytesIO(frames), out, tag=2)
+        self.assertEqual(out.getvalue()[:1], b'\x12')
+
+        with self.assertRaises(RuntimeError):
+            unwrap_grpc_stream(BytesIO(frames[:-1]), BytesIO())
+
+    def test_grpc_compression(self):
+        from io import BytesIO
+        import zlib
+        messages = [b'short', b'long message ' * 200]
+        collection = b''.join(encode_message(1, 'bytes', m) for m in messages)
+
+        for compression in ('gzip', 'deflate'):
+            out = BytesIO()
+            wrap_grpc_stream(BytesIO(collection), out, FrameCompressor(compression, threshold=100))
+            frames = out.getvalue()
+            self.assertEqual(frames[:10], encode_grpc_frame(b'short'))
+            self.assertEqual(frames[10:11], b'\x01')
+            self.assertLess(len(frames), len(collection))
+
+            out = BytesIO()
+            unwrap_grpc_stream(BytesIO(frames), out)
+            self.assertEqual(out.getvalue(), collection)
+
+            frame = encode_grpc_frame(messages[1], compression)
+            self.assertEqual(read_grpc_frame(BytesIO(frame)), messages[1])
+
+        compressed = zlib.compress(b'hello')
+        frame = b'\x01' + encode_uint32_big_endian(len(compressed)) + compressed
+        self.assertEqual(read_grpc_frame(BytesIO(frame)), b'hello')
+        self.assertEqual(encode_grpc_frame(b'hello', 'gzip')[:1], b'\x00')
+
+    def test_asyncio_streams(self):
+        import sys
+        if sys.version_info < (3, 6):
+            self.skipTest('asyncio API requires Python 3.6+')
+        import asyncio
+        from io import BytesIO
+        from protowire import aio
+
+        # no async syntax here to keep this file importable in Python 2
+        loop = asyncio.new_event_loop()
+        run = loop.run_until_complete
+        def collect(async_gen):
+            results = []
+            while True:
+                try:
+                    results.append(run(async_gen.__anext__()))
+                except StopAsyncIteration:
+                    return results
+
+        class Writer(object):
+            def __init__(self):
+                self.data = b''
+            def write(self, data):
+                self.data += data
+            def drain(self):
+                return asyncio.sleep(0)
+
+        def reader(data, fragment_size=3):
+            stream = asyncio.StreamReader(loop=loop) if sys.version_info < (3, 10) else asyncio.StreamReader()
+            for i in range(0, len(data), fragment_size):
+                stream.feed_data(data[i:i+fragment_size])
+            stream.feed_eof()
+            return stream
+
+        messages = [b'x' * (i * 37 % 300 + 1) for i in range(20)]
+        collection = b''.join(encode_message(1, 'bytes', m) for m in messages)
+        frames = b''.join(encode_grpc_frame(m) for m in messages)
+
+        try:
+            self.assertEqual(run(aio.read_varint(reader(b'\x96\x01'))), 150)
+            msg_string = b'\x0A\x06hello!\x18\x96\x01\x45\x9C\xFF\xFF\xFF'
+            self.assertEqual(collect(aio.parse_stream(reader(msg_string))), parse_bytes(msg_string))
+            # a truncated trailing entry is an error in both versions
+            for truncated in (msg_string[:-2], msg_string[:-4], b'\x0A\x06hel', b'\x0A'):
+                self.assertRaises(RuntimeError, collect, aio.parse_stream(reader(truncated)))
+                self.assertRaises(RuntimeError, list, parse_stream(BytesIO(truncated)))
+
+            writer = Writer()
+            run(aio.wrap_grpc_stream(reader(collection), writer))
+            self.assertEqual(writer.data, frames)
+
+            writer = Writer()
+            run(aio.unwrap_grpc_stream(reader(frames), writer))
+            self.assertEqual(writer.data, collection)
+
+            self.assertEqual(collect(aio.read_grpc_frames(reader(frames))), messages)
+
+            writer = Writer()
+            run(aio.write_grpc_frame(writer, messages[-1], 'gzip'))
+            self.assertEqual(collect(aio.read_grpc_frames(reader(writer.data))), messages[-1:])
+        finally:
+            loop.close()
+
+    def test_grpc_batch_client(self):
+        from protowire.grpc_client import percentile, summarize_latencies
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 3)
+        self.assertEqual(percentile([1, 2, 3, 4], 99.9), 4)
+        summary = summarize_latencies([0.002, 0.001], 0.5)
+        self.assertEqual((summary['calls'], summary['calls_per_second'], summary['p50_ms']), (2, 4, 2))
+
+        server, url = start_test_grpc_server(self)
+        from io import BytesIO
+        from protowire.grpc_client import batch_client
+
+        def batch(method, requests, **kwargs):
+            out = BytesIO()
+            # (empty requests are not dropped as default values)
+            collection = b''.join(b'\x0a' + encode_varint(len(r)) + r for r in requests)
+            stats = batch_client(BytesIO(collection), out, url + method, **kwargs)
+            self.assertEqual(stats['calls'], len(requests) - requests.count(b'error'))
+            self.assertEqual(stats['errors'], requests.count(b'error'))
+            return [msg for msg, _, _ in parse_bytes(out.getvalue())]
+
+        try:
+            requests = [b'request %d' % i for i in range(50)] + [b'']
+            expected = [r[::-1] for r in requests]
+            self.assertEqual(batch('Reverse', requests, concurrency=4, n_channels=2), expected)
+            self.assertEqual(sorted(batch('Reverse', requests, ordered=False)), sorted(expected))
+            # failed calls do not stop the batch and get empty responses
+            self.assertEqual(batch('Reverse', [b'ab', b'error', b'cd'], concurrency=1), [b'ba', b'', b'dc'])
+
+            streams = [encode_message(1, 'bytes', b'a') + encode_message(1, 'bytes', b'b')]
+            self.assertEqual(batch('Join', streams, stream_request=True), [b'a+b'])
+            self.assertEqual(batch('Repeat', [b'x'], stream_response=True, tag=2),
+                [encode_message(2, 'bytes', b'x') * 2])
+        finally:
+            server.stop(None)
+
+    def test_grpc_bench(self):
+        from protowire.grpc_bench import LatencyHistogram, summarize, run_benchmark, write_histogram
+        histogram = LatencyHistogram(sub_bucket_bits=5)
+        for latency_us in list(range(1, 101)) + [100000]:
+            histogram.record(latency_us * 1e-6)
+        self.assertEqual(histogram.count, 101)
+        self.assertAlmostEqual(histogram.percentile(50), 51e-6)
+        self.assertAlmostEqual(histogram.percentile(99), 100e-6, delta=100e-6/16)
+        self.assertAlmostEqual(histogram.percentile(100), 0.1)
+        buckets = list(histogram.buckets())
+        self.assertEqual(sum(count for _, _, count in buckets), 101)
+        for lower, upper, _ in buckets:
+            self.assertLessEqual(upper - lower, lower / 16 + 1e-6)
+        from io import BytesIO
+        out = BytesIO()
+        write_histogram(histogram, out)
+        self.assertEqual(out.getvalue().splitlines()[-1], b'98.304\t102.400\t1')
+
+        server, url = start_test_grpc_server(self)
+        try:
+            streams = encode_message(1, 'bytes', b'a') + encode_message(1, 'bytes', b'b')
+            for method, stream_request, stream_response, request in [
+                    ('Reverse', False, False, b'hello'),
+                    ('Join', True, False, streams),
+                    ('Repeat', False, True, b'hello'),
+                    ('Echo', True, True, streams)]:
+                histogram, errors, elapsed = run_benchmark(url + method, [request],
+                    stream_request, stream_response, duration=0.2, concurrency=2)
+                self.assertGreater(histogram.count, 0)
+                self.assertEqual(errors, 0)
+
+            histogram, errors, elapsed = run_benchmark(url + 'Reverse', [b'a', b'b'],
+                duration=60, concurrency=2, qps=50, max_calls=10)
+            self.assertEqual(histogram.count, 10)
+            self.assertGreaterEqual(elapsed, 9 / 50.0)
+            summary = summarize(histogram, elapsed, errors)
+            self.assertLessEqual(summary['p50_ms'], summary['p999_ms'])
+
+            histogram, errors, _ = run_benchmark(url + 'Missing', [b'a'], duration=0.1, concurrency=1)
+            self.assertEqual(histogram.count, 0)
+            self.assertGreater(errors, 0)
+        finally:
+            server.stop(None)
+
     def test_parse_bytess(self):
         messages = parse_bytes(b'\x0A\x06hello!\x39\xAE\xFA\x90\x14\x00\x00\x00\x00\x18\x64\x45\x9C\xFF\xFF\xFF\x55\xd8\x0f\x49\x40')
         self.assertEquals(len(messages), 5)
@@ -122,6 +394,25 @@ class TestUnits(unittest.TestCase):
         self.assertEquals(wire, protowire.wire_type.FIXED32)
         self.assertLess(abs(decode_field(msg, 'float') - 3.141592), 1e-7)
 
+    def test_parse_buffer(self):
+        from io import BytesIO
+        msg_string = b'\x0A\x06hello!\x39\xAE\xFA\x90\x14\x00\x00\x00\x00\x18\x96\x01\x45\x9C\xFF\xFF\xFF'
+        from_buffer = list(parse_buffer(msg_string))
+        from_stream = list(parse_stream(BytesIO(msg_string)))
+        self.assertEqual(len(from_buffer), 4)
+        for (msg, field, wire), (ref_msg, ref_field, ref_wire) in zip(from_buffer, from_stream):
+            self.assertEqual(field, ref_field)
+            self.assertEqual(wire, ref_wire)
+            if wire == protowire.wire_type.VARINT:
+                self.assertEqual(msg, ref_msg)
+            else:
+                self.assertEqual(bytes(msg), ref_msg)
+        self.assertEqual(list(parse_buffer(b'')), [])
+        self.assertEqual(parse_bytes(msg_string), from_stream)
+
+        with self.assertRaises(RuntimeError):
+            list(parse_buffer(b'\x0A\x06hell'))
+
     def test_zigzag(self):
         self.assertEqual(encode_zigzag(2147483647, 32), 4294967294)
         self.assertEqual(decode_zigzag(4294967294), 2147483647)
@@ -155,6 +446,531 @@ class TestUnits(unittest.TestCase):
 
         self.assertEqual(parse_bytes_with_spec(b'\xFF\xFF\xFF\xFF', 'sfixed32'), -1)
 
+    def test_compile_spec(self):
+        decoder = compile_spec(parse_spec('1:[string],2:{1:double,3:[1:fixed64]}'))
+        self.assertIs(compile_spec(decoder), decoder)
+        msg_string = encode_message(1, 'string', 'a') + encode_message(1, 'string', 'b') + \
+            encode_message(2, 'bytes', encode_message(3, 'bytes', encode_message(1, 'fixed64', 7))) + \
+            encode_message(4, 'int', 5)
+        expected = { '1': ['a', 'b'], '2': { '3': [{ '1': 7 }] } }
+        self.assertEqual(decoder.decode_bytes(msg_string), expected)
+        self.assertEqual(decoder.decode_bytes(msg_string), expected)
+        self.assertEqual(parse_bytes_with_spec(msg_string, decoder), expected)
+
+        with self.assertRaises(RuntimeError):
+            decoder.decode_bytes(encode_message(2, 'int', 1))
+        with self.assertRaises(RuntimeError):
+            compile_spec({ '1': 'nonsense' })
+
+    def test_parse_packed(self):
+        import array
+        from protowire.proto_decoding import packed_array_typecode
+        values = {
+            'float': [1.5, -2.0, 0.0],
+            'double': [3.25, 0.0, -1e100],
+            'bool': [True, False, True],
+            'int': [0, 1, 150, 2**40],
+            'int32': [5, 300],
+            'int64': [2**63],
+            'sint32': [-1, 0, 2147483647, -2147483648],
+            'sint64': [-100, 100],
+            'fixed32': [0, 0xffffffff],
+            'fixed64': [1, 0xffffffffffffffff],
+            'sfixed32': [-1, 100],
+            'sfixed64': [-2**63, 2**63-1]
+        }
+        for protobuf_type, expected in values.items():
+            encoded = [str(v) for v in expected] if protobuf_type == 'bool' else expected
+            msg_string = encode_message(2, protobuf_type, encoded)
+            self.assertEqual(parse_bytes_with_spec(msg_string, { '2': [protobuf_type] }), { '2': expected })
+            decoded = compile_spec({ '2': [protobuf_type] }, packed_arrays=True).decode_bytes(msg_string)['2']
+            self.assertIsInstance(decoded, array.array)
+            self.assertEqual(list(decoded), expected)
+
+        # packed chunks and unpacked elements of the same field are concatenated
+        msg_string = encode_message(1, 'sint32', [1, -2]) + encode_message(1, 'sint32', 3) + \
+            encode_message(1, 'sint32', [4])
+        self.assertEqual(parse_bytes_with_spec(msg_string, { '1': ['sint32'] }), { '1': [1, -2, 3, 4] })
+        decoded = compile_spec({ '1': ['sint32'] }, packed_arrays=True).decode_bytes(msg_string)
+        self.assertEqual(decoded, { '1': array.array(packed_array_typecode('sint32'), [1, -2, 3, 4]) })
+
+        with self.assertRaises(RuntimeError):
+            parse_bytes_with_spec(b'\x0a\x03\x00\x00\x00', { '1': ['float'] })
+        with self.assertRaises(RuntimeError):
+            parse_bytes_with_spec(b'\x0a\x01\x80', { '1': ['int'] })
+
+    def test_packed_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy not installed')
+
+        values = {
+            'float': [1.5, -2.0],
+            'fixed64': [1, 0xffffffffffffffff],
+            'sfixed32': [-1, 100],
+            'int': [0, 150, 2**40],
+            'sint64': [-100, 100, -2**63, 2**63-1],
+            'bool': [True, False]
+        }
+        for protobuf_type, expected in values.items():
+            encoded = encode_message(2, protobuf_type, [str(v) for v in expected] \
+                if protobuf_type == 'bool' else expected)
+            dtype = numpy.uint64 if protobuf_type == 'fixed64' else None
+            self.assertEqual(encode_message(2, protobuf_type, numpy.array(expected, dtype=dtype)), encoded)
+            decoded = compile_spec({ '2': [protobuf_type] }, packed_arrays='numpy').decode_bytes(encoded)['2']
+            self.assertIsInstance(decoded, numpy.ndarray)
+            self.assertEqual(decoded.tolist(), expected)
+
+        self.assertEqual(encode_message(2, 'int', numpy.array([-1])), encode_message(2, 'int', [-1]))
+        self.assertEqual(encode_message(2, 'float', numpy.array([])), b'')
+
+    def test_wire_parser(self):
+        msg_string = b'\x0A\x06hello!\x39\xAE\xFA\x90\x14\x00\x00\x00\x00\x18\x96\x01\x45\x9C\xFF\xFF\xFF' + \
+            encode_message(6, 'bytes', encode_message(8, 'sfixed32', -100) + encode_message(2, 'int', [1, 2]))
+
+        for fragment_size in (1, 3, len(msg_string)):
+            parser = WireParser()
+            events = []
+            for i in range(0, len(msg_string), fragment_size):
+                for field, wire, value in parser.feed(msg_string[i:i+fragment_size]):
+                    events.append((value if wire == protowire.wire_type.VARINT else bytes(value), field, wire))
+            parser.close()
+            self.assertEqual(events, parse_bytes(msg_string))
+
+        parser = WireParser(parse_spec('1:string,3:int,6:{8:sfixed32,2:[int]}'))
+        events = list(parser.feed(msg_string[:10]))
+        self.assertEqual(events, [(1, protowire.wire_type.LENGTH_DELIM, 'hello!')])
+        events = list(parser.feed(msg_string[10:]))
+        self.assertEqual(events, [
+            (3, protowire.wire_type.VARINT, 150),
+            (6, protowire.wire_type.LENGTH_DELIM, { '8': -100, '2': [1, 2] })
+        ])
+
+        # feeding again before using the earlier events loses nothing
+        parser = WireParser()
+        first = parser.feed(msg_string[:12])
+        second = parser.feed(msg_string[12:])
+        parser.close()
+        self.assertEqual([(value, field, wire) for field, wire, value in first + second], parse_bytes(msg_string))
+
+        parser = WireParser()
+        list(parser.feed(b'\x0A\x06hel'))
+        with self.assertRaises(RuntimeError):
+            parser.close()
+
+    def test_decode_stats(self):
+        from io import BytesIO
+        from protowire.stats import DecodeStats
+        inner = encode_message(1, 'int', 300) + encode_message(2, 'string', 'x' * 100)
+        msg = encode_message(3, 'bytes', inner) * 2 + encode_message(4, 'int', [1, 2]) + \
+            encode_message(5, 'string', 'skipped')
+        spec = parse_spec('3:[1:int,2:string],4:[int]')
+
+        stats = DecodeStats(n_largest=2)
+        self.assertEqual(parse_stream_with_spec(BytesIO(msg), spec, stats),
+            parse_stream_with_spec(BytesIO(msg), spec))
+        fields = dict(((f['path'], f['wire_type']), (f['count'], f['bytes']))
+            for f in stats.as_dict()['fields'])
+        self.assertEqual(fields, {
+            ('3', 2): (2, 2 * len(inner)),
+            ('3.1', 0): (2, 4),
+            ('3.2', 2): (2, 200),
+            ('4', 2): (1, 2),
+            ('5', 2): (1, 7)
+        })
+        self.assertEqual(sorted(stats.subtrees), ['', '3'])
+        self.assertEqual(stats.subtrees['3'][0], 2)
+        from protowire.proto_decoding import CompiledSpec, InstrumentedSpec
+        self.assertIs(type(compile_spec(spec)), CompiledSpec)
+        self.assertIsInstance(compile_spec(spec, stats=stats), InstrumentedSpec)
+        self.assertEqual(stats.as_dict()['largest_payloads'],
+            [{'path': '3', 'bytes': len(inner)}] * 2)
+
+        stats = DecodeStats()
+        frames = BytesIO()
+        wrap_grpc_stream(BytesIO(encode_message(1, 'bytes', b'a' * 100) * 3), frames, stats=stats)
+        unwrap_grpc_stream(BytesIO(frames.getvalue()), BytesIO(), stats=stats)
+        frame_stats = stats.as_dict()['frames']
+        self.assertEqual((frame_stats['count'], frame_stats['bytes']), (6, 600))
+        self.assertEqual(frame_stats['size_distribution'], [[64, 127, 6]])
+
+    def test_parse_projection(self):
+        from io import BytesIO, RawIOBase
+
+        class Pipe(RawIOBase):
+            def __init__(self, data):
+                self.stream = BytesIO(data)
+            def readable(self):
+                return True
+            def readinto(self, b):
+                # short reads
+                data = self.stream.read(min(len(b), 100))
+                b[:len(data)] = data
+                return len(data)
+
+        msg = encode_message(1, 'bytes', b'x' * 100000) + encode_message(2, 'int', 2 ** 40) + \
+            encode_message(3, 'fixed32', 3) + encode_message(4, 'fixed64', 4) + \
+            encode_message(5, 'bytes', encode_message(1, 'int', 5)) + encode_message(6, 'string', 'six')
+        spec = parse_spec('6:string,5:{1:int}')
+        expected = {'6': 'six', '5': {'1': 5}}
+        self.assertEqual(parse_stream_with_spec(BytesIO(msg), spec), expected)
+        self.assertEqual(parse_stream_with_spec(Pipe(msg), spec), expected)
+        self.assertEqual(parse_bytes_with_spec(msg, spec), expected)
+        self.assertEqual(parse_bytes_with_spec(msg, {'5': {}}), {'5': {}})
+
+        for stream_class in (BytesIO, Pipe):
+            with self.assertRaises(RuntimeError):
+                parse_stream_with_spec(stream_class(msg[:1000]), spec)
+        with self.assertRaises(RuntimeError):
+            parse_bytes_with_spec(msg[:1000], spec)
+
+    def test_inspect(self):
+        from protowire.inspection import inspect
+        inner = encode_message(1, 'int', 150) + encode_message(2, 'string', u'öäå')
+        msg = encode_message(3, 'bytes', inner) + encode_message(4, 'fixed64', 7) + \
+            encode_message(5, 'int', [1, 2, 300]) + encode_message(6, 'string', 'a') + \
+            encode_message(6, 'string', 'b') + encode_message(7, 'bytes', b'\x08')
+        self.assertEqual(inspect(msg), {
+            '3': {'1': 150, '2': u'öäå'},
+            '4': 7,
+            '5': {'hex': '0102ac02'},
+            '6': ['a', 'b'],
+            '7': {'hex': '08'}
+        })
+        self.assertEqual(inspect(msg, max_depth=0)['3'], {'hex': '08960112' + '06c3b6c3a4c3a5'})
+        self.assertEqual(inspect(b''), {})
+        # a printable submessage with a string is still a submessage
+        self.assertEqual(inspect(encode_message(2, 'bytes', encode_message(1, 'string', 'x' * 40))),
+            {'2': {'1': 'x' * 40}})
+        self.assertEqual(inspect(encode_message(1, 'string', 'hello') + b'\x12\x00'),
+            {'1': 'hello', '2': ''})
+        with self.assertRaises(RuntimeError):
+            inspect(b'\x08')
+        with self.assertRaises(RuntimeError):
+            inspect(b'\x0b\x00') # group
+
+    def test_filtering(self):
+        from io import BytesIO
+        from protowire.filtering import filter_buffer, filter_stream, parse_condition
+
+        class Fragmented(BytesIO):
+            def read(self, n=-1):
+                return BytesIO.read(self, min(n, 7) if n > 0 else 7)
+
+        elements = [
+            encode_message(3, 'string', 'hello') + encode_message(2, 'bytes', encode_message(1, 'int', 10)),
+            encode_message(3, 'string', 'help') + encode_message(4, 'int', [1, 2, 3]),
+            encode_message(3, 'string', 'world') + encode_message(2, 'bytes', encode_message(1, 'int', 5)) +
+                encode_message(2, 'bytes', encode_message(1, 'int', 20)) + encode_message(5, 'double', 0.5),
+            b''
+        ]
+        entries = [encode_message(1, 'bytes', e) for e in elements]
+        other = encode_message(2, 'bytes', elements[0])
+        collection = b''.join(entries) + other
+
+        def matching(conditions, **kwargs):
+            result = [bytes(e) for e in filter_buffer(collection, conditions, **kwargs)]
+            out = BytesIO()
+            n = filter_stream(Fragmented(collection), out, conditions, **kwargs)
+            self.assertEqual(out.getvalue(), b''.join(result))
+            self.assertEqual(n, len(result))
+            return result
+
+        self.assertEqual(matching(['3:string=hello'], field_number=1), [entries[0]])
+        self.assertEqual(matching(['3:string^=hel']), [entries[0], entries[1], other])
+        self.assertEqual(matching(['3:string^=hel'], limit=2), entries[:2])
+        self.assertEqual(matching(['3:string!=hello'], field_number=1), entries[1:3])
+        self.assertEqual(matching(['2.1:int>=10']), [entries[0], entries[2], other])
+        self.assertEqual(matching(['2.1:int>10', '3:string=world']), [entries[2]])
+        self.assertEqual(matching(['2.1:int<10', '3:string=hello']), [])
+        self.assertEqual(matching(['4:int=2']), [entries[1]])
+        self.assertEqual(matching(['5:double<1']), [entries[2]])
+        self.assertEqual(matching(['9:int=0']), [])
+
+        # payloads on the path that are not messages do not match
+        for payload in (b'hello', b'\x08\x96', b'\x12\x05abc'):
+            element = encode_message(1, 'bytes', encode_message(2, 'bytes', payload) +
+                encode_message(2, 'bytes', encode_message(1, 'int', 1)))
+            self.assertEqual(len(list(filter_buffer(element, ['2.1:int=1']))), 1)
+            self.assertEqual(len(list(filter_buffer(element, ['2.1:int=2']))), 0)
+            self.assertEqual(filter_stream(Fragmented(element), BytesIO(), ['2.1:int=1']), 1)
+        self.assertEqual(filter_stream(BytesIO(collection), None, ['3:string^=hel']), 3)
+
+        for invalid in ('3=hello', '3:foo=1', '2.1:int^=1', 'x:int=1'):
+            with self.assertRaises(RuntimeError):
+                parse_condition(invalid)
+        with self.assertRaises(RuntimeError):
+            list(filter_buffer(collection[:-1], ['3:string=hello']))
+
+        # only payloads that do not parse are skipped, other errors are raised
+        condition = parse_condition('2.1:int=1')
+        def fail(value):
+            raise RuntimeError("decoding failed")
+        condition.test = fail
+        element = encode_message(1, 'bytes', encode_message(2, 'bytes', encode_message(1, 'int', 1)))
+        with self.assertRaises(RuntimeError) as context:
+            list(filter_buffer(element, [condition]))
+        self.assertEqual(str(context.exception), "decoding failed")
+
+        # any non-zero varint is a true bool
+        element = encode_message(1, 'bytes', encode_message(6, 'int', 2) + encode_message(7, 'int', [0, 2]))
+        self.assertEqual(len(list(filter_buffer(element, ['6:bool=true']))), 1)
+        self.assertEqual(len(list(filter_buffer(element, ['6:bool=false']))), 0)
+        self.assertEqual(len(list(filter_buffer(element, ['7:bool=true', '7:bool=false']))), 1)
+
+    def test_columnar_export(self):
+        from io import BytesIO, StringIO
+        from protowire.columnar import export_columns, read_columnar, CsvWriter, ColumnarWriter
+
+        elements = [
+            encode_message(1, 'int', 150) + encode_message(2, 'double', 0.5) +
+                encode_message(3, 'string', u'öäå') + encode_message(4, 'bytes', encode_message(1, 'sint64', -3)),
+            encode_message(5, 'bytes', b'\x00\xff') + encode_message(6, 'bool', 'true'),
+            b'',
+            encode_message(1, 'int', 2 ** 63) + encode_message(4, 'bytes', b'') + encode_message(9, 'int', 1)
+        ]
+        spec = parse_spec('1:int,2:double,3:string,4:{1:sint64},5:bytes,6:bool')
+        expected = [
+            ('1', [150, None, None, 2 ** 63]),
+            ('2', [0.5, None, None, None]),
+            ('3', [u'öäå', None, None, None]),
+            ('4.1', [-3, None, None, None]),
+            ('5', [None, b'\x00\xff', None, None]),
+            ('6', [None, 1, None, None])
+        ]
+
+        out = BytesIO()
+        self.assertEqual(export_columns(elements, spec, ColumnarWriter(out), chunk_rows=3), 4)
+        chunks = list(read_columnar(BytesIO(out.getvalue())))
+        self.assertEqual([len(chunk[0]) for chunk in chunks], [3, 1])
+        self.assertEqual([(c.name, c.tolist()) for c in chunks[0]], [(n, v[:3]) for n, v in expected])
+        self.assertEqual([(c.name, c.tolist()) for c in chunks[1]], [(n, v[3:]) for n, v in expected])
+        self.assertEqual(chunks[0][1].values.typecode, 'd')
+
+        import sys
+        text = StringIO() if sys.version_info[0] >= 3 else BytesIO() # UTF-8 in Python 2
+        export_columns(iter(elements), spec, CsvWriter(text))
+        csv_text = text.getvalue()
+        if isinstance(csv_text, bytes):
+            csv_text = csv_text.decode('utf-8')
+        self.assertEqual(csv_text.split('\n'), [
+            '1,2,3,4.1,5,6',
+            u'150,0.5,öäå,-3,,',
+            ',,,,00ff,1',
+            ',,,,,',
+            '9223372036854775808,,,,,',
+            ''
+        ])
+
+        with self.assertRaises(RuntimeError):
+            export_columns(elements, parse_spec('1:[int]'), CsvWriter(StringIO()))
+        with self.assertRaises(RuntimeError):
+            list(read_columnar(BytesIO(out.getvalue()[:-1])))
+
+    def test_spec_encoding(self):
+        from io import BytesIO, StringIO
+        from protowire.spec_encoding import encode_with_spec, encode_records, read_json_records
+        from protowire.grpc_frame import unwrap_grpc_stream
+
+        spec = parse_spec('1:int,2:[int],3:{1:string,2:[bool]},4:[{1:double}],5:[string],6:hex,7:sint32,8:bool')
+        obj = {'8': True, '1': 150, '2': [1, 2, 300], '3': {'1': u'öäå', '2': [True, False]},
+            '4': [{'1': 0.5}, {}], '5': ['a', '', 'b'], '6': '00ff', '7': -3, '9': None}
+        encoded = encode_with_spec(obj, spec)
+        self.assertEqual(encoded[:4], encode_message(1, 'int', 150) + encode_message(2, 'int', [1, 2, 300])[:1])
+        del obj['9']
+        self.assertEqual(parse_bytes_with_spec(encoded, spec), obj)
+        self.assertEqual(encode_with_spec({'1': 0, '2': 5, '4': {}}, spec),
+            encode_message(2, 'int', [5]) + b'\x22\x00')
+
+        for invalid in ({'9': 1}, {'1': [1]}, {'3': 5}, {'1': 1.5}, {'1': '150'}, {'1': True},
+                        {'2': [1, 'a']}, {'4': [{'1': 'x'}]}, {'5': [1]}, {'6': 'xyz'}, {'6': 5}, {'8': 'yes'}):
+            with self.assertRaises(RuntimeError):
+                encode_with_spec(invalid, spec)
+        with self.assertRaises(RuntimeError) as context:
+            encode_with_spec({'6': '0g'}, spec)
+        self.assertIn('field 6', str(context.exception))
+        fixed_spec = parse_spec('1:fixed32,2:sfixed32,3:fixed64,4:[sfixed64]')
+        fixed = {'1': 2 ** 32 - 1, '2': -2 ** 31, '3': 2 ** 64 - 1, '4': [-2 ** 63, 2 ** 63 - 1]}
+        self.assertEqual(parse_bytes_with_spec(encode_with_spec(fixed, fixed_spec), fixed_spec), fixed)
+        for field, value in (('1', 2 ** 32), ('1', -1), ('2', 2 ** 31), ('3', 2 ** 64), ('4', [0, 2 ** 63])):
+            with self.assertRaises(RuntimeError) as context:
+                encode_with_spec({field: value}, fixed_spec)
+            self.assertIn('field ' + field, str(context.exception))
+        self.assertEqual(encode_with_spec({'1': 150.0, '4': [{'1': 1}]}, spec),
+            encode_with_spec({'1': 150, '4': [{'1': 1.0}]}, spec))
+
+        element_spec = parse_spec('1:int,2:string')
+        records = [{'1': 1, '2': 'x' * 200}, {}, {'2': 'y'}]
+        # empty elements are kept
+        expected = b''.join(b'\x12' + encode_varint(len(m)) + m
+            for m in (encode_with_spec(r, element_spec) for r in records))
+        for text in (u'{"1": 1, "2": "%s"}\n\n{}\n{"2": "y"}\n', u'[{"1": 1, "2": "%s"},\n{}, {"2": "y"}]'):
+            out = BytesIO()
+            n = encode_records(read_json_records(StringIO(text % ('x' * 200))), out, element_spec,
+                tag=2, flush_size=10)
+            self.assertEqual(n, 3)
+            self.assertEqual(out.getvalue(), expected)
+
+        # with flush_size=0 each record is flushed before the next one is read
+        class Flushed(BytesIO):
+            flushed = b''
+            def flush(self):
+                self.flushed = self.getvalue()
+        out = Flushed()
+        def flushed_records():
+            for n, record in enumerate(records):
+                self.assertEqual(out.flushed, expected[:len(out.flushed)])
+                self.assertEqual(len(parse_bytes(out.flushed)), n)
+                yield record
+        encode_records(flushed_records(), out, element_spec, tag=2, flush_size=0)
+        self.assertEqual(out.flushed, expected)
+
+        frames = BytesIO()
+        encode_records(records, frames, element_spec, grpc=True)
+        unwrapped = BytesIO()
+        unwrap_grpc_stream(BytesIO(frames.getvalue()), unwrapped)
+        # the empty message is not written by unwrap
+        self.assertEqual(list(parse_collection_with_spec(BytesIO(unwrapped.getvalue()), element_spec)),
+            [records[0], records[2]])
+
+        with self.assertRaises(RuntimeError):
+            list(read_json_records(StringIO(u'{"1": 1}\n{"1": ')))
+
+    def test_parse_collection_with_spec(self):
+        from io import BytesIO
+        collection = encode_message(1, 'bytes', encode_message(2, 'int', 3)) + \
+            encode_message(1, 'bytes', encode_message(2, 'int', 4) + encode_message(3, 'string', 'x'))
+        elements = parse_collection_with_spec(BytesIO(collection), parse_spec('2:int,3:string'))
+        self.assertEqual(next(elements), { '2': 3 })
+        self.assertEqual(list(elements), [{ '2': 4, '3': 'x' }])
+
+    def test_parse_parallel(self):
+        import os, tempfile
+        from protowire import parallel
+        collection = b''.join(encode_message(1, 'bytes',
+            encode_message(2, 'int', i) + encode_message(3, 'string', 'x' * (i % 7)))
+            for i in range(1, 200)) + encode_message(4, 'bytes', encode_message(2, 'int', 1))
+        spec = parse_spec('1:[2:int,3:string],4:{2:int}')
+        expected = parse_bytes_with_spec(collection, spec)
+        self.assertEqual(len(parallel.chunk_ranges(collection, 8)), 8)
+        self.assertEqual(parallel.parse_bytes_with_spec_parallel(collection, spec, 2), expected)
+        # dict specs with int keys are accepted like by the other entry points
+        self.assertEqual(parallel.parse_bytes_with_spec_parallel(collection,
+            { 1: [{ 2: 'int', 3: 'string' }], 4: { 2: 'int' } }, 2), expected)
+
+        element_spec = parse_spec('2:int,3:string')
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, collection)
+            os.close(fd)
+            self.assertEqual(parallel.parse_file_with_spec_parallel(path, spec, 2), expected)
+            self.assertEqual(list(parallel.parse_file_collection_with_spec_parallel(path, element_spec, 2)),
+                expected['1'] + [{ '2': 1 }])
+        finally:
+            os.remove(path)
+
+        # the chunks are decoded in worker processes where available
+        if parallel.ProcessPoolExecutor is not None:
+            pids = list(parallel.map_chunks(os.getpid, [()] * 4, 2))
+            self.assertNotIn(os.getpid(), pids)
+
+    def test_field_index(self):
+        import os, tempfile
+        from protowire.field_index import FieldIndex, IndexedFile
+        data = b''.join(encode_message(1, 'bytes', encode_message(2, 'int', i)) for i in range(1, 50)) + \
+            encode_message(3, 'int', 150) + encode_message(4, 'fixed32', 7) + encode_message(1, 'string', 'x')
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            with IndexedFile(path) as indexed:
+                self.assertTrue(os.path.exists(path + '.pwidx'))
+                self.assertEqual(len(indexed), 52)
+                msg, field, wire = indexed[10]
+                self.assertEqual((bytes(msg), field, wire),
+                    (encode_message(2, 'int', 11), 1, protowire.wire_type.LENGTH_DELIM))
+                self.assertEqual(indexed[49], (150, 3, protowire.wire_type.VARINT))
+                self.assertEqual(bytes(indexed[50][0]), b'\x07\x00\x00\x00')
+                self.assertEqual(bytes(indexed.field_entry(1, 49)[0]), b'x')
+                self.assertEqual(len(list(indexed.field(1))), 50)
+
+            loaded = FieldIndex.load(path + '.pwidx')
+            built = FieldIndex.build(data)
+            self.assertEqual([loaded.entry(n) for n in range(len(loaded))],
+                [built.entry(n) for n in range(len(built))])
+            with IndexedFile(path) as indexed:
+                self.assertEqual(parse_bytes_with_spec(indexed.field_entry(1, 3)[0], { '2': 'int' }), { '2': 4 })
+
+            # rewritten in place with the same size and modification time
+            stat = os.stat(path)
+            with open(path, 'r+b') as f:
+                f.write(encode_message(6, 'bytes', encode_message(2, 'int', 1))[:1])
+            os.utime(path, (stat.st_atime, stat.st_mtime))
+            with IndexedFile(path) as indexed:
+                self.assertEqual(indexed[0][1:], (6, protowire.wire_type.LENGTH_DELIM))
+                self.assertEqual(len(list(indexed.field(1))), 49)
+
+            # a truncated sidecar is rejected and rebuilt
+            with open(path + '.pwidx', 'r+b') as f:
+                f.truncate(os.path.getsize(path + '.pwidx') - 3)
+            self.assertRaises(RuntimeError, FieldIndex.load, path + '.pwidx')
+            with IndexedFile(path) as indexed:
+                self.assertEqual(len(indexed), 52)
+            self.assertEqual(len(FieldIndex.load(path + '.pwidx')), 52)
+
+            # an index that cannot be saved is only used in memory
+            with IndexedFile(path, os.path.join(path + '.missing', 'index')) as indexed:
+                self.assertEqual(len(list(indexed.field(1))), 49)
+        finally:
+            os.remove(path)
+            os.remove(path + '.pwidx')
+
+    def test_parse_file_with_spec(self):
+        import os, tempfile
+        msg_string = encode_message(3, 'string', 'hello') + \
+            encode_message(6, 'bytes', encode_message(8, 'sfixed32', -100))
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, msg_string)
+            os.close(fd)
+            spec = { '3': 'string', '6': { '8': 'sfixed32' } }
+            self.assertEqual(parse_file_with_spec(path, spec), { '3': 'hello', '6': { '8': -100 } })
+            open(path, 'wb').close()
+            self.assertEqual(parse_file_with_spec(path, spec), {})
+        finally:
+            os.remove(path)
+
+    def test_truncated_input(self):
+        import os, tempfile
+        from io import BytesIO
+        from protowire.proto_decoding import parse_buffer_projected, parse_stream_projected, index_buffer
+        decoders = [
+            lambda data: list(parse_stream(BytesIO(data))),
+            parse_bytes,
+            lambda data: list(parse_buffer(data)),
+            lambda data: parse_bytes_with_spec(data, { '1': 'int' }),
+            lambda data: parse_stream_with_spec(BytesIO(data), { '1': 'int' }),
+            lambda data: list(parse_buffer_projected(data, { 2: 1 })),
+            lambda data: list(parse_stream_projected(BytesIO(data), { 2: 1 })),
+            lambda data: list(index_buffer(data))
+        ]
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            # a partial tag, length or payload fails in every decoder, EOF
+            # is only accepted between entries
+            for truncated in (b'\x08', b'\x08\x96', b'\x0a', b'\x0a\x05ab', b'\x0d\x01', b'\x08\x01\x0a'):
+                for decode in decoders:
+                    self.assertRaises(RuntimeError, decode, truncated)
+                with open(path, 'wb') as f:
+                    f.write(truncated)
+                self.assertRaises(RuntimeError, parse_file_with_spec, path, { '1': 'int' })
+            for decode in decoders:
+                decode(b'\x08\x01\x10\x02')
+        finally:
+            os.remove(path)
+
     def test_parse_spec(self):
         self.assertEqual(parse_spec('float'), 'float')
         self.assertEqual(parse_spec('1:float,2:int'), { '1': 'float', '2': 'int' })
@@ -167,6 +983,43 @@ class TestUnits(unittest.TestCase):
                 }]
             }
         })
+        self.assertEqual(parse_spec('{ 1: [{2:int}], 02:{3:[1:bool]} }'), {
+            '1': [{ '2': 'int' }],
+            '2': { '3': [{ '1': 'bool' }] }
+        })
+        # a trailing comma is allowed
+        for spec in ('1:int,', '1:[2:int,],', '{1:{2:int,}}'):
+            self.assertEqual(list(parse_spec(spec).keys()), ['1'])
+        for invalid in ('', '1:int,,', ',1:int', '1:foo', 'x:int', '-1:int', '1:[int', '1:{2:int', '1:int]', '1:int;2:int'):
+            with self.assertRaises(RuntimeError):
+                parse_spec(invalid)
+
+        # cached specs are not shared with the callers
+        parse_spec('1:float,2:int')['1'] = 'int'
+        self.assertEqual(parse_spec('1:float,2:int'), { '1': 'float', '2': 'int' })
+
+    def test_spec_file(self):
+        import os, tempfile
+        from protowire.proto_decoding import save_spec, load_spec
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            save_spec('1:[2:int],3:{4:string}', path)
+            self.assertEqual(load_spec(path), { '1': [{ '2': 'int' }], '3': { '4': 'string' } })
+            with open(path, 'w') as f:
+                f.write('{"format": "protowire-spec-1", "spec": {"1": "foo"}}')
+            with self.assertRaises(RuntimeError):
+                load_spec(path)
+            with open(path, 'w') as f:
+                f.write('{"1": "int"}')
+            with self.assertRaises(RuntimeError):
+                load_spec(path)
+            with open(path, 'w') as f:
+                f.write('1:int')
+            with self.assertRaises(RuntimeError):
+                load_spec(path)
+        finally:
+            os.remove(path)
 
 class TestCommandLine(unittest.TestCase):
     def test_bash(self):
@@ -196,6 +1049,11 @@ class TestCommandLine(unittest.TestCase):
 
         self.assertEqual(len(longMsgOut), 203)
 
+        self.assertEqual(getOutputBash(
+            """pw string %s |
+            pw-grpc-frame wrap --compression gzip --compression_threshold 10 |
+            pw-grpc-frame unwrap""" % longMsg), getOutputBash("pw string %s" % longMsg))
+
         self.assertEqual(getOutputBash("pw int 0"), b'')
         self.assertEqual(getOutputBash("pw string ''"), b'')
         self.assertEqual(getOutputBash("pw 2 int 0"), b'')
@@ -220,5 +1078,80 @@ class TestCommandLine(unittest.TestCase):
             pw-decode 1:double""").strip(),
             b'{"1": 3.2345}')
 
+        self.assertEqual(getOutputBash(
+            """f=$(mktemp) && ((pw 3 string hello) && (pw 2 int 100 | pw 2 bytes)) > $f &&
+            pw-decode '3:string,2:{2:int}' --file $f; rm -f $f""").strip(),
+            b'{"2": {"2": 100}, "3": "hello"}')
+
+        self.assertEqual(getOutputBash(
+            """f=$(mktemp) && printf '\\x08\\x96' > $f &&
+            pw-decode 1:int --file $f 2>/dev/null; echo $?; rm -f $f""").strip(),
+            b'1')
+
+        self.assertEqual(getOutputBash(
+            """((pw 3 string hello | pw bytes) && (pw 2 int 100 | pw bytes)) |
+            pw-decode '3:string,2:int' --stream"""),
+            b'{"3": "hello"}\n{"2": 100}\n')
+
+        self.assertEqual(getOutputBash(
+            """((pw 2 int 3 5) && (pw 2 int 7)) | pw-decode '2:[int]'""").strip(),
+            b'{"2": [3, 5, 7]}')
+
+        self.assertEqual(getOutputBash(
+            """((pw 3 string hello | pw bytes) && (pw 2 int 100 | pw bytes)) |
+            pw-decode '1:[2:int,3:string]' --jobs 2""").strip(),
+            b'{"1": [{"3": "hello"}, {"2": 100}]}')
+
+        self.assertEqual(getOutputBash(
+            """pw 2 int 100 | pw 3 bytes | pw-decode '3:{2:int}' --stats 2>&1 >/dev/null |
+            grep -c '"path"'""").strip(), b'4')
+
+        self.assertEqual(getOutputBash(
+            """((pw 3 string hello) && (pw 2 int 100 | pw 2 bytes)) | pw-decode --raw""").strip(),
+            b'{"2":{"2":100},"3":"hello"}')
+
+        self.assertEqual(getOutputBash(
+            """printf '{"3": "hello"}\\n{"2": 100}\\n' | pw-encode '2:int,3:string'"""),
+            getOutputBash("((pw 3 string hello | pw bytes) && (pw 2 int 100 | pw bytes))"))
+
+        self.assertEqual(getOutputBash(
+            """((pw 3 string hello | pw bytes) && (pw 2 int 100 | pw bytes)) |
+            pw-decode '2:int,3:string' --export csv""").strip(), b'2,3\n,hello\n100,')
+
+        self.assertEqual(getOutputBash(
+            """((pw 3 string hello | pw bytes) && (pw 3 string help | pw bytes) && (pw 3 string x | pw bytes)) |
+            pw-filter '3:string^=hel' --count""").strip(), b'2')
+
+        self.assertEqual(getOutputBash(
+            """printf '3 string hello\\n2 {  # nested\\n  2 int 100\\n}\\n' | pw --batch"""),
+            getOutputBash("((pw 3 string hello) && (pw 2 int 100 | pw 2 bytes))"))
+
+        # -- ends the options, other values starting with - are options
+        self.assertEqual(getOutputBash("pw string -- -x"), b'\x0a\x02-x')
+        self.assertEqual(getOutputBash("pw 2 int -- -5"), getOutputBash("pw 2 int -5"))
+        self.assertEqual(getOutputBash("pw string -x 2>/dev/null; echo $?").strip(), b'2')
+
+    def test_pw_batch(self):
+        from io import BytesIO
+        from protowire.commandline import pw_batch
+        out = BytesIO()
+        pw_batch(BytesIO(u'1 string "h\u00e9llo w\u00f6rld"  # caf\u00e9\n2 string -x\n'.encode('utf-8')), out)
+        self.assertEqual(out.getvalue(),
+            encode_message(1, 'string', u'h\u00e9llo w\u00f6rld') + encode_message(2, 'string', '-x'))
+
+    def test_pw_startup(self):
+        import subprocess, sys
+
+        # the common pw path must not import these
+        slow_modules = ['argparse', 'contextlib', 'json', 'zlib', 'shlex']
+        script = ("import sys; sys.argv = ['pw', '2', 'int', '150']; "
+            "from protowire.commandline import pw; pw(); "
+            "sys.stderr.write(repr(sorted(m for m in %r if m in sys.modules)))" % slow_modules)
+        process = subprocess.Popen([sys.executable, '-c', script],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual(out, b'\x10\x96\x01')
+        self.assertEqual(err.strip(), b'[]')
+
 if __name__ == '__main__':
     unittest.main()